@@ -0,0 +1,90 @@
+""" Commit message parser benchmark
+"""
+# pylint: disable-msg=C0301, C0111
+#
+# Compares the single-pass CommandParser with the regular expressions the
+# hook used before it, on ordinary messages and on long ticket lists. Each
+# message is parsed `repeat` times, or for about a second when a single
+# parse takes that long, as the regex path does on the long word:
+#
+#   python bench/command_parser.py [repeat]
+#
+# The results differ when a ticket prefix follows a command without a space
+# and the reference runs into the next one, as in "refsbug2#3": the parser
+# reads the command "refs" and tickets 2 and 3, the old expression the word
+# "refsbug" and no command.
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'github'))
+
+from commands import CommandParser
+
+ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
+ticket_reference = ticket_prefix + '[0-9]+'
+ticket_command =  (r'(?P<action>[A-Za-z]*).?'
+                   '(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
+                   (ticket_reference, ticket_reference))
+
+command_re = re.compile(ticket_command)
+ticket_re = re.compile(ticket_prefix + '([0-9]+)')
+
+COMMANDS = {'close': '_cmdClose', 'closed': '_cmdClose', 'closes': '_cmdClose',
+            'fix': '_cmdClose', 'fixed': '_cmdClose', 'fixes': '_cmdClose',
+            'addresses': '_cmdRefs', 're': '_cmdRefs', 'references': '_cmdRefs',
+            'refs': '_cmdRefs', 'ref': '_cmdRefs', 'see': '_cmdRefs',
+            'return': '_cmdReturns', 'returns': '_cmdReturns'}
+
+# seconds after which a message isn't parsed again
+BUDGET = 1.0
+
+MESSAGES = {
+    'plain': "Changed blah and foo to do this or that without any ticket.",
+    'documented': "Changed blah and foo to do this or that. Fixes #10 and #12, and refs #12.",
+    'long text': "Refactored the ticket module. " * 200 + "See ticket:42.",
+    'long list': "Fixes " + ", ".join(['#%d' % i for i in xrange(1, 2001)]) + ".",
+    'dangling and': "Fixes " + " and ".join(['#%d' % i for i in xrange(1, 2001)]) + " and",
+    'separators': "refs #1" + ", " * 20000 + "x",
+    'long word': "x" * 20000 + " fixes #1",
+}
+
+
+def regex_parse(msg):
+    results = []
+    for cmd, tkts in command_re.findall(msg):
+        funcname = COMMANDS.get(cmd.lower())
+        if funcname:
+            for tkt_id in ticket_re.findall(tkts):
+                results.append((tkt_id, funcname))
+    return results
+
+
+def timed(parse, msg, repeat, budget=BUDGET):
+    """Return the result of `parse(msg)` and the seconds a call takes on
+    average over `repeat` calls, or over fewer once `budget` seconds are
+    spent."""
+    start = time.time()
+    calls = 0
+    while True:
+        result = parse(msg)
+        calls += 1
+        elapsed = time.time() - start
+        if calls >= repeat or elapsed >= budget:
+            return result, elapsed / calls
+
+
+def main(repeat=200):
+    parser = CommandParser(COMMANDS)
+    print "%-14s %12s %12s %8s" % ('message', 'regex (us)', 'parser (us)', 'same')
+    for name in sorted(MESSAGES):
+        msg = MESSAGES[name]
+        old_result, old = timed(regex_parse, msg, repeat)
+        new_result, new = timed(parser.parse, msg, repeat)
+        print "%-14s %12.1f %12.1f %8s" % (name, old * 1e6, new * 1e6, old_result == new_result)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,96 @@
+""" Startup benchmark
+"""
+# pylint: disable-msg=C0301, C0111
+#
+# Measures what loading the plugin costs a process that never receives a
+# post-receive request, like a Trac worker or a trac-admin command: the
+# time to import the package and to create the GithubPlugin component of
+# an environment, and the modules this loads besides Trac's own. Each run
+# is a fresh interpreter; the results are printed as JSON.
+#
+#   python bench/startup.py [--runs 10] [--output results.json]
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+import simplejson
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# run in a fresh interpreter: load Trac and open the environment first, so
+# that only the plugin's own cost is measured
+PROBE = r"""
+import sys, time
+sys.path.insert(0, %(root)r)
+from trac.env import Environment
+from trac.web.main import RequestDispatcher
+env = Environment(%(env)r)
+RequestDispatcher(env)
+before = set(sys.modules)
+start = time.time()
+import github.github
+imported = time.time()
+from github.github import GithubPlugin
+plugin = GithubPlugin(env)
+created = time.time()
+modules = set(sys.modules) - before
+import simplejson
+print simplejson.dumps({'import_seconds': imported - start,
+                        'component_seconds': created - imported,
+                        'modules': sorted(m for m in modules
+                                          if sys.modules[m] is not None
+                                          and not m.startswith('github'))})
+"""
+
+
+def create_env(path):
+    from trac.env import Environment
+    env = Environment(path, create=True,
+                      options=[('components', 'github.*', 'disabled'),
+                               ('trac', 'database', 'sqlite:db/trac.db')])
+    env.shutdown()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--runs', type='int', default=10, help='interpreters started')
+    parser.add_option('--output', help='write the results to this file instead of stdout')
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='github-startup-')
+    try:
+        envdir = os.path.join(tmpdir, 'env')
+        create_env(envdir)
+        probe = PROBE % {'root': ROOT, 'env': envdir}
+        runs = []
+        for i in xrange(options.runs):
+            output = subprocess.Popen([sys.executable, '-c', probe],
+                                      stdout=subprocess.PIPE).communicate()[0]
+            runs.append(simplejson.loads(output.splitlines()[-1]))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def median(key):
+        values = sorted([run[key] for run in runs])
+        return values[len(values) / 2]
+    report = {'runs': len(runs),
+              'import_seconds': median('import_seconds'),
+              'component_seconds': median('component_seconds'),
+              'modules': runs[0]['modules']}
+    output = simplejson.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        fd = open(options.output, 'w')
+        try:
+            fd.write(output + '\n')
+        finally:
+            fd.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
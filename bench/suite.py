@@ -0,0 +1,280 @@
+""" Benchmark suite
+"""
+# pylint: disable-msg=C0301, C0111
+#
+# Builds throwaway Trac environments on SQLite and measures the import of
+# the revision map, the rendering of wiki text with commit links and the
+# processing of post-receive requests; the results are printed as JSON so
+# that runs of different releases can be compared:
+#
+#   python bench/suite.py [--revmap-sizes 10000,100000] [--push-sizes 1,10,100]
+#                         [--output results.json]
+#
+# Trac, Genshi and GitPython must be importable.
+
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import platform
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import simplejson
+import trac
+from trac.env import Environment
+from trac.mimeview import Context
+from trac.test import Mock, MockPerm
+from trac.ticket import Ticket
+from trac.web.api import RequestDone
+from trac.web.href import Href
+from trac.wiki.formatter import format_to_html
+
+from github.github import GithubPlugin
+
+APITOKEN = 'benchtoken'
+TICKETS = 50
+
+
+def commit_hash(rev):
+    return hashlib.sha1('commit %d' % rev).hexdigest()
+
+
+def write_revmap(path, size):
+    """Write a revision map of `size` commits, newest first, in the format
+    of `git log --format='%H%n%s%n%b'` on a git-svn clone."""
+    fd = open(path, 'w')
+    try:
+        for rev in xrange(size, 0, -1):
+            fd.write("%s\nCommit number %d\n\nSome details about it.\n\n"
+                     "git-svn-id: http://svn.example.org/trunk@%d 1234-5678\n\n"
+                     % (commit_hash(rev), rev, rev))
+    finally:
+        fd.close()
+
+
+def create_env(path, options=()):
+    config = [('components', 'github.*', 'enabled'),
+              ('github', 'apitoken', APITOKEN),
+              ('trac', 'database', 'sqlite:db/trac.db')]
+    env = Environment(path, create=True, options=config + list(options))
+    return env, GithubPlugin(env)
+
+
+def upgrade(env, plugin):
+    db = env.get_db_cnx()
+    plugin.upgrade_environment(db)
+    db.commit()
+
+
+def bench_import(tmpdir, size):
+    revmap = os.path.join(tmpdir, 'revmap-%d' % size)
+    write_revmap(revmap, size)
+    env, plugin = create_env(os.path.join(tmpdir, 'import-%d' % size))
+    #enabled once the environment exists, so that the import is timed by
+    #the upgrade rather than done on creation; the options are read when
+    #the environment is opened
+    env.config.set('github', 'enable_revmap', '1')
+    env.config.set('github', 'svn_revmap', revmap)
+    env.config.save()
+    env.shutdown()
+    env = Environment(env.path)
+    plugin = GithubPlugin(env)
+    start = time.time()
+    upgrade(env, plugin)
+    elapsed = time.time() - start
+
+    #an upgrade after new commits were added to the map
+    added = max(size / 100, 1)
+    write_revmap(revmap, size + added)
+    start = time.time()
+    upgrade(env, plugin)
+    incremental = time.time() - start
+    return env, plugin, [
+        {'name': 'revmap_import', 'commits': size, 'seconds': elapsed,
+         'commits_per_second': size / elapsed},
+        {'name': 'revmap_import_incremental', 'commits': size, 'added': added,
+         'seconds': incremental},
+        ]
+
+
+def wiki_text(size, rng, paragraphs=20):
+    """Wiki text mixing svn revisions, abbreviated and full hashes of known
+    commits, unknown hashes and plain words."""
+    lines = []
+    for i in xrange(paragraphs):
+        words = []
+        for j in xrange(30):
+            rev = rng.randint(1, size)
+            kind = rng.random()
+            if kind < 0.05:
+                words.append('r%d' % rev)
+            elif kind < 0.10:
+                words.append(commit_hash(rev)[:rng.randint(7, 12)])
+            elif kind < 0.12:
+                words.append(commit_hash(rev))
+            elif kind < 0.15:
+                words.append(hashlib.md5(str(rng.random())).hexdigest()[:8])
+            else:
+                words.append(rng.choice(['added', 'decade', 'the', 'fix', 'for',
+                                         'cafe', 'feed', 'beef', 'deadbeef']))
+        lines.append(' '.join(words))
+    return '\n\n'.join(lines)
+
+
+def bench_wiki(env, plugin, size, rounds=5, source='svn_revmap'):
+    rng = random.Random(size)
+    req = Mock(href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+               perm=MockPerm(), authname='bench', chrome={}, tz=None, locale=None)
+    context = Context.from_request(req, 'wiki', 'Bench')
+    texts = [wiki_text(size, rng) for i in xrange(rounds)]
+    words = sum([len(text.split()) for text in texts])
+    results = []
+    for cache in ('cold', 'warm'):
+        if cache == 'cold':
+            plugin.revmap_cache.clear()
+        start = time.time()
+        for text in texts:
+            format_to_html(env, context, text)
+        elapsed = time.time() - start
+        results.append({'name': 'wiki_format', 'commits': size, 'cache': cache, 'source': source,
+                        'pages': rounds, 'words': words, 'seconds': elapsed,
+                        'words_per_second': words / elapsed})
+    return results
+
+
+class HookRequest(object):
+    """The parts of a request the commit hook uses."""
+
+    def __init__(self, payload):
+        self.path_info = '/github/%s' % APITOKEN
+        self.method = 'POST'
+        self.args = {'payload': payload}
+        self.status = None
+
+    def get_header(self, name):
+        if name.lower() == 'content-length':
+            return str(len(self.args['payload']))
+
+    def redirect(self, url):
+        raise RequestDone
+
+    def send_response(self, code):
+        self.status = code
+
+    def send_header(self, name, value):
+        pass
+
+    def write(self, data):
+        pass
+
+
+def push_payload(first, size, rng):
+    commits = []
+    for i in xrange(first, first + size):
+        tkt = rng.randint(1, TICKETS)
+        message = rng.choice(['refs #%d', 'Fix the frobnicator, see #%d',
+                              'fixes #%d', 'Tidy up, no ticket%.0s'])
+        commits.append({'id': hashlib.sha1('push %d' % i).hexdigest(),
+                        'url': 'https://github.com/example/repo/commit/%d' % i,
+                        'message': message % tkt,
+                        'timestamp': '2010-01-01T00:00:00-08:00',
+                        'author': {'name': 'Bench', 'email': 'bench@example.org'}})
+    return simplejson.dumps({'repository': {'name': 'repo',
+                                            'url': 'https://github.com/example/repo'},
+                             'ref': 'refs/heads/master',
+                             'commits': commits})
+
+
+def bench_hook(path, push_sizes, repeat, options=()):
+    env, plugin = create_env(path, options=options)
+    upgrade(env, plugin)
+    for i in xrange(TICKETS):
+        ticket = Ticket(env)
+        ticket['summary'] = 'Ticket %d' % (i + 1)
+        ticket['reporter'] = 'bench'
+        ticket.insert()
+
+    rng = random.Random(0)
+    results = []
+    first = 0
+    for size in push_sizes:
+        timings = []
+        for i in xrange(repeat):
+            req = HookRequest(push_payload(first, size, rng))
+            first += size
+            start = time.time()
+            if plugin.match_request(req):
+                try:
+                    plugin.process_request(req)
+                except RequestDone:
+                    pass
+            timings.append(time.time() - start)
+        timings.sort()
+        results.append({'name': 'hook_push', 'commits': size,
+                        'options': dict(('%s.%s' % (section, name), value)
+                                        for section, name, value in options),
+                        'requests': repeat, 'median_seconds': timings[len(timings) / 2],
+                        'max_seconds': timings[-1]})
+    env.shutdown()
+    return results
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--revmap-sizes', default='10000,100000',
+                      help='comma separated numbers of commits in the revision maps')
+    parser.add_option('--push-sizes', default='1,10,100',
+                      help='comma separated numbers of commits per push')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='pushes of each size')
+    parser.add_option('--output', help='write the results to this file instead of stdout')
+    parser.add_option('--keep', action='store_true', help='keep the environments')
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='github-bench-')
+    results = []
+    try:
+        for size in [int(s) for s in options.revmap_sizes.split(',') if s]:
+            env, plugin, import_results = bench_import(tmpdir, size)
+            results += import_results
+            results += bench_wiki(env, plugin, size)
+            env.config.set('github', 'revmap_snapshot', 'revmap.snapshot')
+            start = time.time()
+            plugin._write_snapshot(env.get_db_cnx())
+            results.append({'name': 'revmap_snapshot_write', 'commits': size,
+                            'seconds': time.time() - start})
+            results += bench_wiki(env, plugin, size, source='snapshot')
+            env.shutdown()
+        push_sizes = [int(s) for s in options.push_sizes.split(',') if s]
+        results += bench_hook(os.path.join(tmpdir, 'hook'), push_sizes, options.repeat)
+        results += bench_hook(os.path.join(tmpdir, 'hook-aggregate'), push_sizes, options.repeat,
+                              [('github', 'aggregate_push', 'true')])
+    finally:
+        if options.keep:
+            sys.stderr.write("environments kept in %s\n" % tmpdir)
+        else:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {'python': platform.python_version(),
+              'trac': trac.__version__,
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    output = simplejson.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        fd = open(options.output, 'w')
+        try:
+            fd.write(output + '\n')
+        finally:
+            fd.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
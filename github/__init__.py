@@ -1,3 +1,4 @@
 """ Github
 """
 from github import GithubPlugin
+from mail import BatchSmtpEmailSender
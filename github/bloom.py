@@ -0,0 +1,55 @@
+""" Bloom filter
+"""
+# pylint: disable-msg=C0301, C0111
+
+import threading
+
+# shortest hash prefix remembered by CommitHashFilter
+MIN_PREFIX = 5
+
+
+class CommitHashFilter(object):
+    """Tells whether a (possibly abbreviated) git hash may be a prefix of
+    one of the hashes added to it, with no false negatives.
+
+    This is a partitioned Bloom filter whose hash functions are slices of
+    the git hash itself, which is already uniformly distributed: one bit
+    per value of the first 5 and first 6 hex digits, and one per value of
+    digits 7 to 12. Tokens of 5 or 6 digits are answered exactly, longer
+    ones are rejected unless both 6 digit slices are known. It takes a
+    fixed 4 MB whatever the number of hashes.
+    """
+
+    def __init__(self):
+        self.prefix5 = bytearray(16 ** 5 // 8)
+        self.prefix6 = bytearray(16 ** 6 // 8)
+        self.slice6 = bytearray(16 ** 6 // 8)
+        self._lock = threading.Lock()
+
+    def add(self, git_hash):
+        git_hash = str(git_hash).lower()
+        self._lock.acquire()
+        try:
+            for bits, value in ((self.prefix5, git_hash[:5]),
+                                (self.prefix6, git_hash[:6]),
+                                (self.slice6, git_hash[6:12])):
+                pos = int(value, 16)
+                bits[pos >> 3] |= 1 << (pos & 7)
+        finally:
+            self._lock.release()
+
+    def __contains__(self, prefix):
+        prefix = str(prefix).lower()
+        if len(prefix) < MIN_PREFIX:
+            return True
+        if len(prefix) == MIN_PREFIX:
+            checks = ((self.prefix5, prefix),)
+        elif len(prefix) < 12:
+            checks = ((self.prefix6, prefix[:6]),)
+        else:
+            checks = ((self.prefix6, prefix[:6]), (self.slice6, prefix[6:12]))
+        for bits, value in checks:
+            pos = int(value, 16)
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
@@ -0,0 +1,93 @@
+""" Cache
+"""
+# pylint: disable-msg=C0301, C0111
+
+import time
+import threading
+
+# link fields of the LRU list
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping whose entries expire after `ttl`
+    seconds. When full, the least recently used entry is evicted.
+
+    A `size` of 0 disables the cache: every lookup is a miss.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is not None and link[EXPIRES] < time.time():
+                self._unlink(link)
+                link = None
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is not None:
+                self._unlink(link)
+            self._append([None, None, key, value, time.time() + self.ttl])
+            while len(self._data) > self.size:
+                self._unlink(self._root[NEXT])
+        finally:
+            self._lock.release()
+
+    def discard_if(self, predicate):
+        """Drop every entry whose key satisfies `predicate`."""
+        self._lock.acquire()
+        try:
+            for key in [key for key in self._data if predicate(key)]:
+                self._unlink(self._data[key])
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._data), 'size': self.size,
+                'ttl': self.ttl}
+
+    def _append(self, link):
+        last = self._root[PREV]
+        link[PREV], link[NEXT] = last, self._root
+        last[NEXT] = self._root[PREV] = link
+        self._data[link[KEY]] = link
+
+    def _unlink(self, link):
+        link[PREV][NEXT], link[NEXT][PREV] = link[NEXT], link[PREV]
+        del self._data[link[KEY]]
@@ -0,0 +1,67 @@
+""" Commit message commands
+"""
+# pylint: disable-msg=C0301, C0111
+
+import re
+from string import ascii_letters
+
+ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
+ticket_reference = ticket_prefix + '[0-9]+'
+# a list of ticket references; each separator must be followed by a
+# reference, so a failed match backtracks over one separator only
+ticket_list_re = re.compile('%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*' %
+                            (ticket_reference, ticket_reference))
+ticket_re = re.compile(ticket_prefix + '([0-9]+)')
+# the word a ticket list may follow
+command_word_re = re.compile(r'[A-Za-z]*\Z')
+
+
+class CommandParser(object):
+    """Finds the ticket commands of a commit message, with the syntax
+    documented in `hook.py`:
+
+        <command> <ticket>[(, | & | and) <ticket>]...
+
+    The message is scanned once for ticket lists; the command of a list is
+    the word ending at most one char, not a newline, before it. Only words
+    as long as the longest known command are looked at, so long runs of
+    letters don't cost more than short ones. `commands` maps the command
+    words, case insensitive, to the values returned by `parse()`.
+
+    The results are those of the regular expression the hook used before,
+    except when a ticket prefix follows a command without a space and the
+    reference runs into the next one: in "refsbug2#3" the command "refs"
+    applies to tickets 2 and 3, where the regular expression took the word
+    "refsbug" followed by "2" and #3, so no command.
+    """
+
+    def __init__(self, commands):
+        self.commands = dict((word.lower(), command)
+                             for word, command in commands.iteritems())
+        self.max_length = max([len(word) for word in self.commands] or [0])
+
+    def parse(self, msg):
+        """Return the `(ticket_id, command)` pairs of a message in order,
+        ticket ids being strings, for the known commands only."""
+        results = []
+        last_end = 0
+        for match in ticket_list_re.finditer(msg):
+            command = self._find_command(msg, last_end, match.start())
+            last_end = match.end()
+            if command is not None:
+                for tkt_id in ticket_re.findall(match.group(0)):
+                    results.append((tkt_id, command))
+        return results
+
+    def _find_command(self, msg, start, end):
+        """Return the command of the ticket list at `end`, looking no
+        further back than `start`."""
+        if end > start and msg[end - 1] not in ascii_letters:
+            if msg[end - 1] == '\n':
+                return None
+            end -= 1
+        start = max(start, end - self.max_length - 1)
+        word = command_word_re.search(msg, start, end).group(0)
+        if not word or len(word) > self.max_length:
+            return None
+        return self.commands.get(word.lower())
@@ -0,0 +1,74 @@
+""" Fetch coalescing
+"""
+# pylint: disable-msg=C0301, C0111
+
+import time
+import threading
+
+
+class _FetchState(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.requested = 0
+        self.completed = 0
+        self.running = False
+
+
+class FetchCoalescer(object):
+    """Runs `fetch(key)` on behalf of concurrent callers so that every
+    caller is served by a fetch started after its request, while bursts of
+    requests for the same key share a single fetch.
+
+    The first caller waits `debounce` seconds before fetching, so requests
+    arriving meanwhile are served by the same fetch; callers arriving while
+    a fetch runs wait for it and then share the next one.
+    """
+
+    def __init__(self, fetch, debounce=0):
+        self.fetch = fetch
+        self.debounce = debounce
+        self.fetches = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def request(self, key):
+        self._lock.acquire()
+        try:
+            state = self._states.setdefault(key, _FetchState())
+            self.requests += 1
+        finally:
+            self._lock.release()
+
+        state.cond.acquire()
+        try:
+            state.requested += 1
+            ticket = state.requested
+            while state.running:
+                state.cond.wait()
+            if state.completed >= ticket:
+                return
+            state.running = True
+        finally:
+            state.cond.release()
+
+        covered = ticket
+        try:
+            if self.debounce > 0:
+                time.sleep(self.debounce)
+            state.cond.acquire()
+            try:
+                covered = state.requested
+            finally:
+                state.cond.release()
+            self.fetches += 1
+            self.fetch(key)
+        finally:
+            state.cond.acquire()
+            try:
+                state.completed = max(state.completed, covered)
+                state.running = False
+                state.cond.notifyAll()
+            finally:
+                state.cond.release()
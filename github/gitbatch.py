@@ -0,0 +1,120 @@
+""" git cat-file --batch
+"""
+# pylint: disable-msg=C0301, C0111
+
+import os
+import threading
+from subprocess import Popen, PIPE
+
+
+class CatFile(object):
+    """A long-lived `git cat-file --batch-check` or `--batch` process on a
+    repository, answering one object name at a time. Not thread-safe, see
+    `CatFilePool`.
+    """
+
+    def __init__(self, repodir, batch=False, git='git'):
+        option = batch and '--batch' or '--batch-check'
+        self.batch = batch
+        #git complains on stderr about every name that isn't a commit,
+        #which would end up in the server log
+        devnull = open(os.devnull, 'w')
+        try:
+            self.proc = Popen([git, 'cat-file', option], cwd=repodir,
+                              stdin=PIPE, stdout=PIPE, stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+
+    def query(self, name):
+        """Return `(sha, type, size, content)` for an object name, content
+        being None for --batch-check, or None if the name is missing or
+        ambiguous."""
+        self.proc.stdin.write(name + '\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline()
+        if not header:
+            raise IOError("git cat-file exited")
+        fields = header.split()
+        if len(fields) != 3:
+            #"<name> missing" or "<name> ambiguous"
+            return None
+        sha, obj_type, size = fields[0], fields[1], int(fields[2])
+        content = None
+        if self.batch:
+            content = self.proc.stdout.read(size)
+            self.proc.stdout.read(1)
+        return sha, obj_type, size, content
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except Exception:
+            pass
+
+
+class CatFilePool(object):
+    """Thread-safe pool of `CatFile` processes on a repository. Each lookup
+    borrows an idle process, starting one if none is idle, and at most
+    `size` idle processes of each kind are kept.
+    """
+
+    def __init__(self, repodir, size=4, git='git'):
+        self.repodir = repodir
+        self.size = size
+        self.git = git
+        self._lock = threading.Lock()
+        self._idle = {False: [], True: []}
+
+    def _query(self, name, batch):
+        self._lock.acquire()
+        try:
+            idle = self._idle[batch]
+            catfile = idle and idle.pop() or None
+        finally:
+            self._lock.release()
+        if catfile is None:
+            catfile = CatFile(self.repodir, batch, self.git)
+        try:
+            result = catfile.query(name)
+        except Exception:
+            #the process is in an unknown state, don't reuse it
+            catfile.close()
+            raise
+        self._lock.acquire()
+        try:
+            if len(self._idle[batch]) < self.size:
+                self._idle[batch].append(catfile)
+                catfile = None
+        finally:
+            self._lock.release()
+        if catfile is not None:
+            catfile.close()
+        return result
+
+    def resolve_commit(self, prefix):
+        """Return the full hash of the commit an abbreviated hash names, or
+        None if it names no commit or several objects."""
+        result = self._query('%s^{commit}' % prefix, False)
+        #a ref with a hex-looking name would win over the abbreviated hash
+        if result is None or not result[0].startswith(prefix.lower()):
+            return None
+        return result[0]
+
+    def commit_message(self, sha):
+        """Return the message of a commit, lines joined with spaces."""
+        result = self._query(sha, True)
+        if result is None or result[1] != 'commit':
+            return None
+        message = result[3].split('\n\n', 1)[1:]
+        lines = message and message[0].splitlines() or []
+        return ' '.join([line for line in lines if line]).decode('utf-8', 'replace')
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop().close()
+        finally:
+            self._lock.release()
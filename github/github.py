@@ -5,37 +5,104 @@
 from trac.core import *
 from trac.core import Component, implements
 from trac.resource import ResourceNotFound
-from trac.config import Option
-from trac.web.api import IRequestFilter, IRequestHandler, RequestDone
+from trac.config import Option, IntOption, BoolOption, FloatOption, ChoiceOption, ListOption
+from trac.web.api import IRequestFilter, IRequestHandler, RequestDone, HTTPBadRequest, \
+        HTTPRequestEntityTooLarge
+from trac.admin import IAdminCommandProvider
 from trac.env import IEnvironmentSetupParticipant
 from trac.versioncontrol import RepositoryManager
 from trac.util.translation import _
-from trac.util.text import shorten_line
+from trac.util.text import shorten_line, printout
 from trac.db import Table, Column, Index, DatabaseManager
 from trac.wiki import IWikiSyntaxProvider
 from genshi.builder import tag
-from hook import CommitHook
+from cache import LRUCache
+from bloom import CommitHashFilter
+from revmap import parse_revmap
+from payload import PushPayload
+from jobs import HookQueue
+from ledger import CommitLedger
+from outbox import NotificationOutbox
+from fetch import FetchCoalescer
+from gitbatch import CatFilePool
+from snapshot import RevmapSnapshot, write_snapshot, file_identity
+from stats import Metrics, timed
 
 import re
+import time
 import os.path
-import simplejson
-
-from git import Git
+import threading
+
+# matches everything get_wiki_syntax may turn into a changeset link
+COMMIT_TOKEN_RE = re.compile(r"\br[1-9]\d*\b|\b[0-9a-fA-F]{5,40}\b")
+# requests redirected to GitHub by pre_process_request
+REDIRECT_ROUTE_RE = re.compile(r"/(browser|changeset)")
+# number of ids looked up per query when resolving links in bulk
+QUERY_CHUNK_SIZE = 100
+# version of the svn_revmap schema, kept in the system table
+REVMAP_VERSION = 2
+# version of the plugin tables other than svn_revmap
+DB_VERSION = 4
+# log import progress every so many batches of revmap_batch_size rows
+REVMAP_PROGRESS_BATCHES = 10
+
+def prefix_range(prefix):
+    """Return the `(low, high)` bounds of the hashes starting with the hex
+    string `prefix`, high being None when there is no upper bound."""
+    stripped = prefix.rstrip('f')
+    if not stripped:
+        return prefix, None
+    return prefix, stripped[:-1] + '%x' % (int(stripped[-1], 16) + 1)
+
+def split_changeset_path(path_info):
+    """Split a /changeset/<rev>/<reponame> path like `str.partition`."""
+    try:
+        return path_info.replace('/changeset/', '').partition("/")
+    except AttributeError:
+        commitinfo = path_info.replace('/changeset/', '')
+        partition = commitinfo.split('/')
+        commitinfo = [partition[0]]
+        if len(partition) > 1:
+            commitinfo.append('/')
+            commitinfo.append('/'.join(partition[1:]))
+        else:
+            commitinfo.append('')
+            commitinfo.append('')
+        return commitinfo
 
 class GithubPlugin(Component):
     implements(IRequestHandler, IRequestFilter, IEnvironmentSetupParticipant,
-            IWikiSyntaxProvider)
+            IWikiSyntaxProvider, IAdminCommandProvider)
 
 
     key = Option('github', 'apitoken', '', doc="""Your GitHub API Token found here: https://github.com/account, """)
     closestatus = Option('github', 'closestatus', '', doc="""This is the status used to close a ticket. It defaults to closed.""")
     browser = Option('github', 'browser', '', doc="""Place your GitHub Source Browser URL here to have the /browser entry point redirect to GitHub.""")
     autofetch = Option('github', 'autofetch', '', doc="""Should we auto fetch the repo when we get a commit hook from GitHub.""")
+    autofetch_debounce = FloatOption('github', 'autofetch_debounce', 1.0, doc="""Seconds to wait before fetching so that a burst of pushes to a repository is served by a single fetch.""")
     # TODO: Removed following line, obsolete
     # repo = Option('trac', 'repository_dir' '', doc="""This is your repository dir""")
     revmap        = Option('github', 'svn_revmap',    '', doc = """a plaintext file mapping svn revisions to git hashes""")
     enable_revmap = Option('github', 'enable_revmap',  0, doc = """use the svn->git map when a request looks like a svn changeset """)
     long_tooltips = Option('github', 'long_tooltips',  0, doc = """don't shorten tooltips""")
+    aggregate_push = BoolOption('github', 'aggregate_push', 'false', doc = """update each ticket once per push, with the messages of all the commits referencing it, instead of once per commit""")
+    max_payload_size = IntOption('github', 'max_payload_size', 10485760, doc = """largest post-receive request accepted, in bytes, 0 for no limit""")
+    ledger_retention_days = IntOption('github', 'ledger_retention_days', 90, doc = """days during which processed commits are remembered, so that redelivered payloads don't update tickets twice""")
+    async_hooks = BoolOption('github', 'async_hooks', 'false', doc = """answer post-receive requests at once and process the commits in a background thread""")
+    queue_poll_interval = IntOption('github', 'queue_poll_interval', 10, doc = """seconds between checks of the hook queue by the background thread""")
+    notification_outbox = BoolOption('github', 'notification_outbox', 'false', doc = """queue ticket notifications and send them from a background thread instead of while processing the commits; set `[notification] email_sender = BatchSmtpEmailSender` to send each batch over a single SMTP connection""")
+    notification_window = IntOption('github', 'notification_window', 60, doc = """seconds a queued ticket notification waits for more changes to the ticket, which are then notified in the same message""")
+    commit_resolver = ChoiceOption('github', 'commit_resolver', ['revmap', 'git'], doc = """how git hashes in wiki text are resolved: `revmap` looks them up in svn_revmap, `git` asks the default repository with long-lived `git cat-file` processes""")
+    git_pool_size = IntOption('github', 'git_pool_size', 4, doc = """number of idle `git cat-file` processes kept per repository by the `git` commit resolver""")
+    revmap_cache_size = IntOption('github', 'revmap_cache_size', 10000, doc = """number of svn_revmap lookups kept in memory, 0 disables the cache""")
+    revmap_cache_ttl  = IntOption('github', 'revmap_cache_ttl',    300, doc = """seconds a cached svn_revmap lookup stays valid""")
+    revmap_incremental = BoolOption('github', 'revmap_incremental', 'true', doc = """only import the commits added to the revision map since the last import, on upgrade and with `trac-admin github import`, instead of rebuilding svn_revmap""")
+    revmap_batch_size = IntOption('github', 'revmap_batch_size', 1000, doc = """number of mappings inserted per statement when importing the revision map""")
+    revmap_snapshot = Option('github', 'revmap_snapshot', '', doc = """file, relative to the environment, to which a compact snapshot of svn_revmap is written on upgrade and by `trac-admin github snapshot`; wiki links are then resolved from the memory-mapped snapshot, falling back to svn_revmap only for commits added since""")
+    revmap_filter_ttl = IntOption('github', 'revmap_filter_ttl',   600, doc = """seconds before the in-memory filter of known git hashes is rebuilt from svn_revmap, 0 disables the filter""")
+    close_commands  = ListOption('github', 'close_commands',  'close, closed, closes, fix, fixed, fixes', doc = """commit message commands closing the tickets they reference""")
+    refs_commands   = ListOption('github', 'refs_commands',   'addresses, re, references, refs, ref, see', doc = """commit message commands adding a comment to the tickets they reference""")
+    return_commands = ListOption('github', 'return_commands', 'return, returns', doc = """commit message commands reassigning the tickets they reference to their reporter""")
 
     SCHEMA = [
             Table('svn_revmap', key = ('svn_rev', 'git_hash'))[
@@ -43,49 +110,179 @@ class GithubPlugin(Component):
                 Column('git_hash'),
                 Column('commit_msg'),
                 Index(['svn_rev', 'git_hash']),
+                Index(['git_hash']),
                 ]
             ]
 
+    # tables created whatever the configuration, with the DB_VERSION
+    # introducing them
+    TABLES = [
+            (1, HookQueue.SCHEMA),
+            (2, CommitLedger.SCHEMA),
+            (3, NotificationOutbox.SCHEMA),
+            (4, CommitLedger.CLAIMS_SCHEMA),
+            ]
+
 
     def __init__(self):
-        self.hook = CommitHook(self.env)
-        self.env.log.debug("API Token: %s" % self.key)
-        self.env.log.debug("Browser: %s" % self.browser)
-        self.processHook = False
+        self.metrics = Metrics()
+        self.revmap_cache = LRUCache(self.revmap_cache_size, self.revmap_cache_ttl)
+        self.outbox = NotificationOutbox(self.env, self.notification_window,
+                                         self.queue_poll_interval, metrics=self.metrics,
+                                         ready=self._is_upgraded)
+        self._hook = None
+        self._hook_lock = threading.Lock()
+        self._revmap_enabled = int(self.enable_revmap) != 0
+        self._long_tooltips = int(self.long_tooltips) != 0
+        self._links_enabled = self._revmap_enabled or self.commit_resolver == 'git'
+        self._hash_filter = None
+        self._hash_filter_built = 0
+        self._hash_filter_lock = threading.Lock()
+        #hashes added to svn_revmap while the filter is rebuilt, None when
+        #no rebuild is running
+        self._hash_filter_pending = None
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self.env.log.debug("API Token: %s", self.key)
+        self.env.log.debug("Browser: %s", self.browser)
+        self._git_pools = {}
+        self.fetcher = FetchCoalescer(self._fetch_repository, self.autofetch_debounce)
+        self.ledger = CommitLedger(self.env, self.ledger_retention_days)
+        self.queue = HookQueue(self.env, self.processPayload, self.queue_poll_interval,
+                               ready=self._is_upgraded)
+        self._workers_started = False
+
+    @property
+    def hook(self):
+        """The `CommitHook`, created when first needed: most processes
+        loading the plugin never receive a post-receive request."""
+        if self._hook is None:
+            self._hook_lock.acquire()
+            try:
+                if self._hook is None:
+                    from hook import CommitHook
+                    commands = {}
+                    for words, funcname in ((self.close_commands, '_cmdClose'),
+                                            (self.refs_commands, '_cmdRefs'),
+                                            (self.return_commands, '_cmdReturns')):
+                        for word in words:
+                            commands[word] = funcname
+                    self._hook = CommitHook(self.env, self._revmap_inserted, commands, self.metrics,
+                                            self.notification_outbox and self.outbox or None,
+                                            self.ledger)
+            finally:
+                self._hook_lock.release()
+        return self._hook
 
     # IEnvironmentSetupParticpant methods
     def environment_created(self):
-        if int(self.enable_revmap):
-            self._upgrade_db(self.env.get_db_cnx())
+        db = self.env.get_db_cnx()
+        if self._revmap_enabled:
+            self._upgrade_db(db)
+        self._upgrade_tables(db)
+        db.commit()
 
     #return true if the db table doesn't exist or needs to be updated
     def environment_needs_upgrade(self, db):
-        if int(self.enable_revmap) == 0:
+        if self._get_db_version(db) < DB_VERSION:
+            return True
+        if not self._revmap_enabled:
             return False
+        if not self._get_revmap_count(db):
+            return True
+        #changes to the revision map file are imported by "github import":
+        #reporting them here would stop the environment until an upgrade
+        return self._get_revmap_version(db) < REVMAP_VERSION
+
+    def upgrade_environment(self, db):
+        #the revmap checks roll back the transaction when svn_revmap doesn't
+        #exist, so they have to come before anything else
+        if self._revmap_enabled:
+            self._upgrade_revmap(db)
+        if self._get_db_version(db) < DB_VERSION:
+            self._upgrade_tables(db)
+
+    def _upgrade_revmap(self, db):
+        if not self._get_revmap_count(db):
+            self._upgrade_db(db)
+            return
+        if self._get_revmap_version(db) < 2:
+            #mappings imported before the git_hash index existed
+            self.env.log.info("adding git_hash index to svn_revmap")
+            cursor = db.cursor()
+            cursor.execute("CREATE INDEX svn_revmap_git_hash_idx ON svn_revmap (git_hash)")
+            self._set_revmap_version(db, REVMAP_VERSION)
+        if self.revmap_incremental:
+            self._update_db(db)
+
+    def _get_revmap_count(self, db):
+        """Return the number of rows in svn_revmap, or None if the table
+        doesn't exist."""
         cursor = db.cursor()
         try:
             cursor.execute("SELECT COUNT(*) FROM svn_revmap")
-            row = cursor.fetchone()
-            #if there's one or more rows, assume everything's ok
-            if row[0] > 0:
-                return False
-            return True
+            return cursor.fetchone()[0]
         except Exception:
             db.rollback()
-            return True
+            return None
 
-    def upgrade_environment(self, db):
-        if int(self.enable_revmap):
-            self._upgrade_db(db)
+    def _get_revmap_signature(self):
+        """Return a string identifying the current content of the revision
+        map file, or None if it can't be read."""
+        try:
+            st = os.stat(self.revmap)
+        except OSError:
+            return None
+        return '%d:%d' % (st.st_size, int(st.st_mtime))
 
-    def _upgrade_db(self, db):
-        #open the revision map
-        if int(self.enable_revmap) == 0:
-            return 0
+    def _upgrade_tables(self, db):
+        version = self._get_db_version(db)
+        db_backend, _unused = DatabaseManager(self.env)._get_connector()
+        cursor = db.cursor()
+        for table_version, tables in self.TABLES:
+            if table_version <= version:
+                continue
+            for table in tables:
+                for stmt in db_backend.to_sql(table):
+                    self.env.log.debug(stmt)
+                    cursor.execute(stmt)
+        self._set_system_value(db, 'github_db_version', DB_VERSION)
+
+    def _get_db_version(self, db):
+        return int(self._get_system_value(db, 'github_db_version') or 0)
+
+    def _get_revmap_version(self, db):
+        return int(self._get_system_value(db, 'github_revmap_version') or 0)
+
+    def _set_revmap_version(self, db, version):
+        self._set_system_value(db, 'github_revmap_version', version)
+
+    def _get_system_value(self, db, name):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s", (name,))
+        row = cursor.fetchone()
+        return row and row[0] or None
+
+    def _set_system_value(self, db, name, value):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s", (name,))
+        if cursor.fetchone():
+            cursor.execute("UPDATE system SET value=%s WHERE name=%s", (str(value), name))
+        else:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)", (name, str(value)))
+
+    def _open_revmap(self):
         try:
-            revmap_fd = open(self.revmap, 'rb')
+            return open(self.revmap, 'rb')
         except IOError:
             raise ResourceNotFound(_("revision map '%(revmap)s' not found", revmap=self.revmap))
+
+    def _upgrade_db(self, db):
+        #open the revision map
+        if not self._revmap_enabled:
+            return 0
+        signature = self._get_revmap_signature()
+        revmap_fd = self._open_revmap()
         cursor = db.cursor()
         try:
             cursor.execute("DROP TABLE svn_revmap;")
@@ -94,55 +291,221 @@ class GithubPlugin(Component):
 
         db_backend, _unused = DatabaseManager(self.env)._get_connector()
         cursor = db.cursor()
+        #create the indexes once the mappings are loaded, it's much faster
+        index_stmts = []
         for table in self.SCHEMA:
             for stmt in db_backend.to_sql(table):
+                if stmt.lstrip().upper().startswith('CREATE INDEX'):
+                    index_stmts.append(stmt)
+                    continue
                 self.env.log.debug(stmt)
                 cursor.execute(stmt)
 
+        try:
+            insert_count, gaps, newest_rev = self._import_revmap(cursor, parse_revmap(revmap_fd))
+        finally:
+            revmap_fd.close()
+
+        for stmt in index_stmts:
+            self.env.log.debug(stmt)
+            cursor.execute(stmt)
+
+        self.env.log.info("inserted %d mappings into svn_revmap, found %d gaps in svn revisions", insert_count, gaps)
+        self._set_revmap_version(db, REVMAP_VERSION)
+        self._set_system_value(db, 'github_revmap_checkpoint', newest_rev)
+        self._set_system_value(db, 'github_revmap_signature', signature)
+        self.revmap_cache.clear()
+        self._set_hash_filter(self._load_hash_filter(db))
+        self._write_snapshot(db)
+        return insert_count
+
+    def _update_db(self, db):
+        """Import only the mappings newer than the last imported svn
+        revision. The revision map lists the newest commits first, so this
+        stops reading the file at the checkpoint."""
+        signature = self._get_revmap_signature()
+        if signature in (None, self._get_system_value(db, 'github_revmap_signature')):
+            return 0
+        checkpoint = self._get_system_value(db, 'github_revmap_checkpoint')
+        if checkpoint is None:
+            cursor = db.cursor()
+            cursor.execute("SELECT MAX(svn_rev) FROM svn_revmap")
+            checkpoint = cursor.fetchone()[0] or 0
+        checkpoint = int(checkpoint)
+        new_hashes = []
+        def new_mappings(revmap_fd):
+            for svn_rev, git_hash, commit_msg in parse_revmap(revmap_fd):
+                if svn_rev <= checkpoint:
+                    break
+                new_hashes.append(git_hash)
+                yield svn_rev, git_hash, commit_msg
+
+        revmap_fd = self._open_revmap()
+        try:
+            insert_count, gaps, newest_rev = self._import_revmap(db.cursor(), new_mappings(revmap_fd))
+        finally:
+            revmap_fd.close()
+
+        self.env.log.info("inserted %d new mappings after r%d into svn_revmap", insert_count, checkpoint)
+        if insert_count:
+            self._set_system_value(db, 'github_revmap_checkpoint', newest_rev)
+        self._set_system_value(db, 'github_revmap_signature', signature)
+        if insert_count:
+            self.revmap_cache.clear()
+            self._add_to_hash_filter(new_hashes)
+            self._write_snapshot(db)
+        return insert_count
+
+    def _import_revmap(self, cursor, mappings):
+        """Insert `(svn_rev, git_hash, commit_msg)` tuples into svn_revmap
+        in batches of `revmap_batch_size`, returning the number of rows
+        inserted, the number of gaps found in the svn revisions and the
+        newest svn revision inserted."""
+        insert_query = "INSERT INTO svn_revmap (svn_rev, git_hash, commit_msg) VALUES (%s, %s, %s)"
+        batch_size = max(self.revmap_batch_size, 1)
         insert_count = 0
-        prev_rev = 0
-        git_hash = revmap_fd.readline()[0:-1]
-        while 1:
-            #make sure this line is the hash
-            if not re.match(r'[0-9a-f]{40}', git_hash):
-                raise Exception("expecting hash, found '%s'" % git_hash)
-            line = revmap_fd.readline()[0:-1]
-
-            if line.startswith('git-svn-id:'):
-                commit_msg = '<no commit message>'
-            else:
-                #slurp lines into the commit messsages until there's a blank line, a line starting with git-svn-id or a hash
-                commit_msg = ''
-                while not re.match(r'[0-9a-f]{40}', line) and not line.startswith('git-svn-id:'):
-                    if len(line) > 0:
-                        if not commit_msg:
-                            commit_msg = line
-                        else:
-                            commit_msg = commit_msg + " " + line
-                    line = revmap_fd.readline()[0:-1]
-
-            if not line.startswith('git-svn-id:'):
-                raise Exception("expected git-svn-id, got '%s'" % line)
-
-            svn_rev_match = re.match(r'^git-svn-id:.*@(\d+) ', line)
-            svn_rev = int(svn_rev_match.group(1))
-
-            insert_query = "INSERT INTO svn_revmap (svn_rev, git_hash, commit_msg) VALUES (%s, %s, %s);"
-            self.env.log.debug(insert_query % (svn_rev, git_hash, commit_msg))
-            cursor.execute(insert_query, (svn_rev, git_hash, commit_msg.decode('utf-8')))
-
-            if prev_rev - 1 != svn_rev:
-                self.env.log.debug("found a gap between r%d and r%d" % (prev_rev, svn_rev))
+        gaps = 0
+        newest_rev = 0
+        prev_rev = None
+        batch = []
+        for mapping in mappings:
+            svn_rev = mapping[0]
+            newest_rev = max(newest_rev, svn_rev)
+            if prev_rev is not None and prev_rev - 1 != svn_rev:
+                gaps += 1
             prev_rev = svn_rev
-
-            insert_count += 1
-            if svn_rev == 1:
-                break
-            git_hash = revmap_fd.readline()[0:-1]
-            while len(git_hash) == 0:
-                git_hash = revmap_fd.readline()[0:-1]
-
-        self.env.log.debug("inserted %d mappings into svn_revmap" % insert_count)
+            batch.append(mapping)
+            if len(batch) >= batch_size:
+                cursor.executemany(insert_query, batch)
+                insert_count += len(batch)
+                batch = []
+                if insert_count % (batch_size * REVMAP_PROGRESS_BATCHES) == 0:
+                    self.env.log.info("imported %d mappings into svn_revmap, now at r%d", insert_count, svn_rev)
+        if batch:
+            cursor.executemany(insert_query, batch)
+            insert_count += len(batch)
+        return insert_count, gaps, newest_rev
+
+    def _load_hash_filter(self, db):
+        """Load every git hash of svn_revmap into a new `CommitHashFilter`."""
+        hash_filter = CommitHashFilter()
+        cursor = db.cursor()
+        cursor.execute("SELECT git_hash FROM svn_revmap")
+        for git_hash, in cursor:
+            hash_filter.add(git_hash)
+        return hash_filter
+
+    def _set_hash_filter(self, hash_filter):
+        """Replace the filter of known git hashes, adding the hashes inserted
+        while it was loaded."""
+        self._hash_filter_lock.acquire()
+        try:
+            if hash_filter is not None:
+                for git_hash in self._hash_filter_pending or []:
+                    hash_filter.add(git_hash)
+            self._hash_filter = hash_filter
+            self._hash_filter_built = time.time()
+            self._hash_filter_pending = None
+        finally:
+            self._hash_filter_lock.release()
+
+    def _add_to_hash_filter(self, hashes):
+        """Add the hashes inserted into svn_revmap to the filter, and to the
+        one being rebuilt if any."""
+        self._hash_filter_lock.acquire()
+        try:
+            if self._hash_filter is not None:
+                for git_hash in hashes:
+                    self._hash_filter.add(git_hash)
+            if self._hash_filter_pending is not None:
+                self._hash_filter_pending.extend(hashes)
+        finally:
+            self._hash_filter_lock.release()
+
+    def _get_hash_filter(self):
+        """Return the filter of known git hashes, or None when disabled or
+        not built yet. A filter missing or older than `revmap_filter_ttl`
+        is rebuilt by a background thread, the current one being used
+        meanwhile, so that no render waits for svn_revmap to be read.
+        """
+        if self.revmap_filter_ttl <= 0:
+            return None
+        if time.time() - self._hash_filter_built >= self.revmap_filter_ttl:
+            self._hash_filter_lock.acquire()
+            try:
+                start = self._hash_filter_pending is None and \
+                        time.time() - self._hash_filter_built >= self.revmap_filter_ttl
+                if start:
+                    self._hash_filter_pending = []
+            finally:
+                self._hash_filter_lock.release()
+            if start:
+                thread = threading.Thread(target=self._rebuild_hash_filter,
+                                          name='github-hash-filter')
+                thread.setDaemon(True)
+                thread.start()
+        return self._hash_filter
+
+    def _rebuild_hash_filter(self):
+        try:
+            hash_filter = self._load_hash_filter(self.env.get_db_cnx())
+        except Exception:
+            self.env.log.warning("could not build the git hash filter, "
+                                 "looking up every hash in svn_revmap")
+            hash_filter = None
+        self._set_hash_filter(hash_filter)
+
+    def _get_snapshot_path(self):
+        if not self.revmap_snapshot:
+            return None
+        return os.path.join(self.env.path, self.revmap_snapshot)
+
+    def _write_snapshot(self, db, path=None):
+        """Write the svn_revmap snapshot, if one is configured, returning the
+        number of commits it holds."""
+        path = path or self._get_snapshot_path()
+        if path is None:
+            return 0
+        cursor = db.cursor()
+        cursor.execute("SELECT svn_rev, git_hash, commit_msg FROM svn_revmap")
+        count = write_snapshot(path, cursor)
+        self.env.log.info("wrote %d mappings to the svn_revmap snapshot %s", count, path)
+        return count
+
+    def _get_snapshot(self):
+        """Return the svn_revmap snapshot, mapped again whenever the file
+        is replaced, or None if there is none."""
+        path = self._get_snapshot_path()
+        if path is None:
+            return None
+        try:
+            identity = file_identity(os.stat(path))
+        except OSError:
+            return None
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.identity == identity:
+            return snapshot
+        self._snapshot_lock.acquire()
+        try:
+            if self._snapshot is None or self._snapshot.identity != identity:
+                try:
+                    self._snapshot = RevmapSnapshot(path)
+                except Exception:
+                    self.env.log.warning("could not read the svn_revmap snapshot %s", path, exc_info=True)
+                    return None
+                #lookups made with the previous snapshot may be out of date
+                self.revmap_cache.clear()
+            return self._snapshot
+        finally:
+            self._snapshot_lock.release()
+
+    def _revmap_inserted(self, git_hash):
+        """Called by `CommitHook` for each row it adds to svn_revmap."""
+        git_hash = git_hash.lower()
+        # cached lookups of a prefix of this hash, including cached misses,
+        # are now out of date
+        self.revmap_cache.discard_if(lambda key: git_hash.startswith(key.lower()))
+        self._add_to_hash_filter([git_hash])
 
     # IWikiSyntaxProvider methods
     def get_wiki_syntax(self):
@@ -158,16 +521,17 @@ class GithubPlugin(Component):
     def get_link_resolvers(self):
         return []
 
+    @timed('wiki_link')
     def _format_changeset_link(self, formatter, ns, match):
         self.env.log.debug("format changeset link")
-        if int(self.enable_revmap) == 0:
+        if not self._links_enabled:
             self.env.log.debug("revmap disabled, skipping thingy")
             return match.group(0)
         self.env.log.debug("revmap enabled: formatting links")
-        commit_data = self._get_commit_data(match.group(0))
+        commit_data = self._get_render_commit_data(formatter, match)
         if len(commit_data) == 1:
             self.env.log.debug(commit_data)
-            if int(self.long_tooltips):
+            if self._long_tooltips:
                 title = commit_data[0]['msg']
             else:
                 title = shorten_line(commit_data[0]['msg'])
@@ -179,102 +543,337 @@ class GithubPlugin(Component):
 
         return match.group(0)
 
+    def _get_render_commit_data(self, formatter, match):
+        """Look up the commit data for one matched token, resolving every
+        candidate token of the text being rendered on the first call so
+        that a page costs a few bulk queries instead of one per token.
+        """
+        commit_id = match.group(0)
+        source = getattr(formatter, 'source', None)
+        if not isinstance(source, basestring):
+            source = match.string
+        resolved = getattr(formatter, '_github_commit_data', None)
+        if resolved is None or resolved[0] is not source:
+            commit_ids = set(m.group(0) for m in COMMIT_TOKEN_RE.finditer(source))
+            commit_ids.add(commit_id)
+            resolved = (source, self._get_commits_data(commit_ids))
+            formatter._github_commit_data = resolved
+        elif commit_id not in resolved[1]:
+            resolved[1].update(self._get_commits_data([commit_id]))
+        return resolved[1][commit_id]
+
     # IRequestHandler methods
     def match_request(self, req):
         self.env.log.debug("Match Request")
-        serve = req.path_info.rstrip('/') == ('/github/%s' % self.key) and req.method == 'POST'
-        if serve:
-            self.processHook = True
+        route = self._get_route(req)
+        if route == 'hook':
+            #before the dispatcher reads the body for the form token check
+            self._check_payload_size(req)
             #This is hacky but it's the only way I found to let Trac post to this request
             #   without a valid form_token
             req.form_token = None
 
-        self.env.log.debug("Handle Request: %s" % serve)
-        return serve
+        self.env.log.debug("Handle Request: %s", route)
+        return route is not None
+
+    def _get_route(self, req):
+        """Return which of the plugin's handlers serves a request, if any;
+        the component is shared by all the requests, so this is worked out
+        again from each request rather than remembered."""
+        path = req.path_info.rstrip('/')
+        if path == '/github/%s' % self.key and req.method == 'POST':
+            return 'hook'
+        if path == '/github/%s/stats' % self.key and req.method == 'GET':
+            return 'stats'
+        return None
 
     def process_request(self, req):
-        if self.processHook:
-            self.processCommitHook(req)
+        route = self._get_route(req)
+        if route == 'stats':
+            self.processStats(req)
+        if route == 'hook':
+            if self.async_hooks:
+                self.queueCommitHook(req)
+            else:
+                self.processCommitHook(req)
         # TODO: Verify this code (and redirect in hook.py also)
         req.send_response(204)
         req.send_header('Content-Length', 0)
         req.write('')
         raise RequestDone
 
+    def processStats(self, req):
+        """Send the metrics of this process and the state of the caches and
+        of the hook queue as JSON."""
+        stats = self.metrics.snapshot()
+        stats['revmap_cache'] = self.revmap_cache.stats()
+        stats['queue'] = self.queue.stats()
+        stats['outbox'] = self.outbox.stats()
+        stats['ledger'] = {'skipped': self.ledger.skipped}
+        stats['fetch'] = {'requests': self.fetcher.requests,
+                          'fetches': self.fetcher.fetches}
+        import simplejson
+        req.send(simplejson.dumps(stats, sort_keys=True), 'application/json')
+
+    def _check_payload_size(self, req):
+        """Refuse payloads larger than `max_payload_size`; called by
+        `match_request`, before anything reads `req.args` and with it the
+        request body."""
+        if self.max_payload_size <= 0:
+            return
+        try:
+            size = int(req.get_header('Content-Length') or 0)
+        except ValueError:
+            size = 0
+        if size > self.max_payload_size:
+            self.env.log.warning("refusing a %d bytes GitHub payload", size)
+            raise HTTPRequestEntityTooLarge(_("Payload larger than %(max)s bytes",
+                                              max=self.max_payload_size))
+
+    def queueCommitHook(self, req):
+        """Check the payload and store it for the background worker."""
+        data = req.args.get('payload')
+        if not data:
+            raise HTTPBadRequest(_("Missing payload"))
+        try:
+            reponame = PushPayload(data).repository['name']
+        except (ValueError, TypeError, KeyError):
+            raise HTTPBadRequest(_("Malformed payload"))
+        self.queue.enqueue(reponame, data)
+        self.env.log.debug("queued GitHub payload for %s", reponame)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('github drain', '',
+               'Process the queued GitHub post-receive payloads',
+               None, self._do_drain)
+        yield ('github queue', '',
+               'Show the GitHub post-receive queue depth and latency',
+               None, self._do_queue)
+        yield ('github retry', '',
+               'Queue the failed GitHub post-receive payloads and ticket notifications again',
+               None, self._do_retry)
+        yield ('github snapshot', '[path]',
+               'Write the svn_revmap snapshot, to `path` or to the revmap_snapshot file',
+               None, self._do_snapshot)
+        yield ('github notify', '',
+               'Send the queued ticket notifications without waiting',
+               None, self._do_notify)
+        yield ('github import', '',
+               'Import the commits added to the revision map since the last import',
+               None, self._do_import)
+
+    def _do_drain(self):
+        printout("Processed %d queued payloads" % self.queue.drain())
+
+    def _do_queue(self):
+        stats = self.queue.stats()
+        depth = stats['depth']
+        printout("pending: %d" % depth.get('pending', 0))
+        printout("running: %d" % depth.get('running', 0))
+        printout("failed:  %d" % depth.get('failed', 0))
+        printout("notifications: %d" % self.outbox.depth().get('pending', 0))
+        if stats['latency_avg'] is not None:
+            printout("latency: %.3fs average, %.3fs max over the last %d payloads"
+                     % (stats['latency_avg'], stats['latency_max'], stats['processed'] + stats['failed']))
+
+    def _do_retry(self):
+        self.queue.retry_failed()
+        self.outbox.retry_failed()
+
+    def _do_snapshot(self, path=None):
+        if path is None and self._get_snapshot_path() is None:
+            printout("No revmap_snapshot file configured in the [github] section")
+            return
+        count = self._write_snapshot(self.env.get_db_cnx(), path)
+        printout("Wrote %d mappings to the svn_revmap snapshot" % count)
+
+    def _do_notify(self):
+        printout("Sent %d ticket notifications" % self.outbox.flush(force=True))
+
+    def _do_import(self):
+        if not self._revmap_enabled:
+            printout("The revision map isn't enabled in the [github] section")
+            return
+        db = self.env.get_db_cnx()
+        if self.revmap_incremental and self._get_revmap_count(db):
+            count = self._update_db(db)
+        else:
+            count = self._upgrade_db(db)
+        db.commit()
+        printout("Imported %d revision map entries" % count)
+
     # This has to be done via the pre_process_request handler
     # Seems that the /browser request doesn't get routed to match_request :(
     def pre_process_request(self, req, handler):
+        if not self._workers_started:
+            self._start_workers()
         if self.browser:
-            serve = req.path_info.startswith('/browser')
-            self.env.log.debug("Handle Pre-Request /browser: %s" % serve)
-            if serve:
+            route = REDIRECT_ROUTE_RE.match(req.path_info)
+            if route is None:
+                return handler
+            if route.group(1) == 'browser':
+                self.env.log.debug("Handle Pre-Request /browser: True")
                 self.processBrowserURL(req)
-
-            serve2 = req.path_info.startswith('/changeset')
-            try:
-                repoinfo = req.path_info.replace('/changeset/', '').partition("/")
-            except AttributeError:
-                repoinfo = req.path_info.replace('/changeset/', '')
-                partition = repoinfo.split('/')
-                repoinfo = [partition[0]]
-                if len(partition) > 1:
-                    repoinfo.append('/')
-                    repoinfo.append('/'.join(partition[1:]))
-                else:
-                    repoinfo.append('')
-                    repoinfo.append('')
-            repo = self.env.get_repository(repoinfo[2])
-            if repo.__class__.__name__ == "GitRepository":
-                self.env.log.debug("Handle Pre-Request /changeset: %s" % serve2)
-            if serve2:
+            else:
+                self.env.log.debug("Handle Pre-Request /changeset: True")
                 self.processChangesetURL(req)
 
         return handler
 
+    def _start_workers(self):
+        """Start the background threads on the first request, to pick up
+        the work queued before a restart; admin commands and upgrades never
+        start them."""
+        self._workers_started = True
+        if self.async_hooks:
+            self.queue.start_worker()
+        if self.notification_outbox:
+            self.outbox.start_worker()
+
+    def _is_upgraded(self):
+        return not self.environment_needs_upgrade(self.env.get_db_cnx())
 
     def post_process_request(self, req, template, data, content_type):
         return (template, data, content_type)
 
     def _get_commit_data(self, commit_id):
-        if int(self.enable_revmap) == 0:
+        if not self._links_enabled:
             return False
-        self.env.log.debug("looking up commit: %s" % commit_id)
+        return self._get_commits_data([commit_id])[commit_id]
+
+    @timed('commit_lookup')
+    def _get_commits_data(self, commit_ids):
+        """Resolve many svn revisions (`r1234`) and git hash prefixes at once.
+
+        Returns a dict mapping each requested id to a list of matches, in the
+        format returned by `_get_commit_data`.
+        """
+        results = {}
+        revs = {}
+        prefixes = {}
+        use_revmap = self._revmap_enabled
+        use_git = self.commit_resolver == 'git'
+        hash_filter = None
+        if not use_git:
+            hash_filter = self._get_hash_filter()
+        snapshot = None
+        if use_revmap:
+            snapshot = self._get_snapshot()
+        for commit_id in commit_ids:
+            cached = self.revmap_cache.get(commit_id)
+            if cached is not None:
+                results[commit_id] = cached
+                continue
+            results[commit_id] = []
+            if commit_id.startswith('r'):
+                if not use_revmap:
+                    continue
+                if snapshot is not None:
+                    #svn revisions are only added by imports, which
+                    #rewrite the snapshot
+                    results[commit_id] = self._snapshot_data(snapshot.lookup_rev(int(commit_id[1:])),
+                                                             commit_id[1:])
+                    self.revmap_cache.set(commit_id, results[commit_id])
+                    continue
+                revs.setdefault(int(commit_id[1:]), []).append(commit_id)
+            elif hash_filter is None or commit_id in hash_filter:
+                if snapshot is not None and not use_git:
+                    matches = snapshot.lookup_prefix(commit_id)
+                    if matches:
+                        results[commit_id] = self._snapshot_data(matches, commit_id)
+                        self.revmap_cache.set(commit_id, results[commit_id])
+                        continue
+                #not in the snapshot, but maybe added by the hook since
+                prefixes.setdefault(commit_id.lower(), []).append(commit_id)
+        if use_git and prefixes:
+            self._resolve_with_git(prefixes, results)
+            for commit_ids in prefixes.values():
+                for commit_id in commit_ids:
+                    self.revmap_cache.set(commit_id, results[commit_id])
+            prefixes = {}
+        if not revs and not prefixes:
+            return results
+        self.env.log.debug("looking up %d revisions and %d hashes (cache: %r)",
+                len(revs), len(prefixes), self.revmap_cache.stats())
         cursor = self.env.get_db_cnx().cursor()
-        if commit_id.startswith('r'):
-            commit_id = commit_id[1:]
-            self.env.log.debug("running query: SELECT git_hash, commit_msg FROM svn_revmap WHERE svn_rev = %s" % commit_id)
-            cursor.execute("SELECT git_hash, commit_msg FROM svn_revmap WHERE svn_rev = %s", (commit_id,))
-            rows = cursor.fetchmany(5)
-        else:
-            self.env.log.debug("running query: SELECT git_hash, commit_msg FROM svn_revmap WHERE git_hash LIKE '%s%%'" % commit_id)
-            cursor.execute("SELECT git_hash, commit_msg FROM svn_revmap WHERE git_hash LIKE '%s%%'" % (commit_id,))
-            rows = cursor.fetchmany(5)
-        results = []
-        for row in rows:
-            #hash is what's in the db, id is the string the user used (usually not the full hash)
-            d = {'hash': row[0],
-                 'msg' : row[1],
-                 'id'  : commit_id,
-            }
-            results.append(d)
+
+        rev_list = sorted(revs)
+        for i in xrange(0, len(rev_list), QUERY_CHUNK_SIZE):
+            chunk = rev_list[i:i + QUERY_CHUNK_SIZE]
+            cursor.execute("SELECT svn_rev, git_hash, commit_msg FROM svn_revmap WHERE svn_rev IN (%s)"
+                    % ','.join(['%s'] * len(chunk)), chunk)
+            for svn_rev, git_hash, commit_msg in cursor:
+                for commit_id in revs.get(svn_rev, []):
+                    results[commit_id].append({'hash': git_hash,
+                                               'msg' : commit_msg,
+                                               'id'  : commit_id[1:],
+                                               })
+
+        prefix_list = sorted(prefixes)
+        for i in xrange(0, len(prefix_list), QUERY_CHUNK_SIZE):
+            chunk = prefix_list[i:i + QUERY_CHUNK_SIZE]
+            clauses = []
+            args = []
+            for prefix in chunk:
+                low, high = prefix_range(prefix)
+                if high is None:
+                    clauses.append("git_hash >= %s")
+                    args.append(low)
+                else:
+                    clauses.append("(git_hash >= %s AND git_hash < %s)")
+                    args.extend([low, high])
+            cursor.execute("SELECT git_hash, commit_msg FROM svn_revmap WHERE %s"
+                    % ' OR '.join(clauses), args)
+            for git_hash, commit_msg in cursor:
+                for prefix in chunk:
+                    if git_hash.startswith(prefix):
+                        #hash is what's in the db, id is the string the user used (usually not the full hash)
+                        for commit_id in prefixes[prefix]:
+                            #a second match is enough to know the id is ambiguous
+                            if len(results[commit_id]) < 2:
+                                results[commit_id].append({'hash': git_hash,
+                                                           'msg' : commit_msg,
+                                                           'id'  : commit_id,
+                                                           })
+        for commit_ids in revs.values() + prefixes.values():
+            for commit_id in commit_ids:
+                self.revmap_cache.set(commit_id, results[commit_id])
         return results
 
+    def _snapshot_data(self, matches, commit_id):
+        for commit in matches:
+            commit['id'] = commit_id
+        return matches
+
+    def _resolve_with_git(self, prefixes, results):
+        """Resolve hash prefixes with `git cat-file` on the default
+        repository instead of svn_revmap, filling `results` like
+        `_get_commits_data` does."""
+        repodir = self._get_repository_dir('')
+        pool = self._git_pools.get(repodir)
+        if pool is None:
+            pool = self._git_pools.setdefault(repodir, CatFilePool(repodir, self.git_pool_size))
+        for prefix, commit_ids in prefixes.iteritems():
+            try:
+                git_hash = pool.resolve_commit(prefix)
+                if git_hash is None:
+                    continue
+                commit_msg = pool.commit_message(git_hash) or ''
+            except Exception:
+                self.env.log.warning("git cat-file failed on %s", repodir, exc_info=True)
+                continue
+            for commit_id in commit_ids:
+                results[commit_id].append({'hash': git_hash,
+                                           'msg' : commit_msg,
+                                           'id'  : commit_id,
+                                           })
+
     def processChangesetURL(self, req):
         self.env.log.debug("processChangesetURL")
         browser = self.browser.replace('/tree/master', '/commit/')
 
-        try:
-            commitinfo = req.path_info.replace('/changeset/', '').partition("/")
-        except AttributeError:
-            commitinfo = req.path_info.replace('/changeset/', '')
-            partition = commitinfo.split('/')
-            commitinfo = [partition[0]]
-            if len(partition) > 1:
-                commitinfo.append('/')
-                commitinfo.append('/'.join(partition[1:]))
-            else:
-                commitinfo.append('')
-                commitinfo.append('')
+        commitinfo = split_changeset_path(req.path_info)
 
         url = "/%s" % (commitinfo[2] + commitinfo[1] + "commit" + commitinfo[1] + commitinfo[0])
         if not url:
@@ -282,7 +881,7 @@ class GithubPlugin(Component):
             url = ''
 
         redirect = '%s%s' % (browser, url)
-        self.env.log.debug("Redirect URL: %s" % redirect)
+        self.env.log.debug("Redirect URL: %s", redirect)
         _out = 'Going to GitHub: %s' % redirect
 
         req.redirect(redirect)
@@ -300,7 +899,7 @@ class GithubPlugin(Component):
         url = req.path_info.replace('/browser', '')
 
         redirect = '%s%s%s' % (browser, rev, url)
-        self.env.log.debug("Redirect URL: %s" % redirect)
+        self.env.log.debug("Redirect URL: %s", redirect)
         _out = 'Going to GitHub: %s' % redirect
 
         req.redirect(redirect)
@@ -309,38 +908,78 @@ class GithubPlugin(Component):
 
     def processCommitHook(self, req):
         self.env.log.debug("processCommitHook")
+        self.processPayload(req.args.get('payload'))
+
+        self.env.log.debug("Redirect URL: %s", req)
+        req.redirect(self.browser)
+
+    @timed('process_payload')
+    def processPayload(self, data):
+        """Fetch the repository if needed and run the commit hook on the
+        commits of a post-receive payload."""
         status = self.closestatus
         if not status:
             status = 'closed'
 
-        if self.autofetch:
-            repodir = RepositoryManager(self.env).repository_dir
-            if not os.path.isabs(repodir):
-                repodir = os.path.join(self.env.path, repodir)
-            # TODO: This was the previous code, the repo options is probably unecessary now.
-            # repodir = "%s/%s" % (self.repo, reponame)
-            self.env.log.debug("Autofetching: %s" % repodir)
-            repo = Git(repodir)
-
-            try:
-                self.env.log.debug("Fetching repo %s" % self.repo)
-                repo.execute(['git', 'fetch'])
-                try:
-                    self.env.log.debug("Resyncing local repo")
-                    self.env.get_repository('').sync()
-                except Exception:
-                    self.env.log.error("git sync failed!")
-            except Exception:
-                self.env.log.error("git fetch failed!")
-
-        data = req.args.get('payload')
-
         if data:
-            jsondata = simplejson.loads(data)
-            reponame = jsondata['repository']['name']
+            payload = PushPayload(data)
+            reponame = payload.repository['name']
 
-            for i in jsondata['commits']:
-                self.hook.process(i, status, self.enable_revmap, reponame)
+            if self.autofetch:
+                self.fetcher.request(self._get_trac_reponame(reponame))
 
-        self.env.log.debug("Redirect URL: %s" % req)
-        req.redirect(self.browser)
+            #the hook records the commits as processed with their ticket
+            #changes, and drops their claims
+            claimed = []
+            commits = self.ledger.claim(reponame, payload.iter_commits(), claimed)
+            try:
+                if self.aggregate_push:
+                    self.hook.process_push(commits, status, self._revmap_enabled, reponame,
+                                           self._get_pusher(payload))
+                else:
+                    for i in commits:
+                        self.hook.process(i, status, self._revmap_enabled, reponame)
+            except:
+                #retrying the payload has to process the unprocessed ones again
+                self.ledger.release(reponame, claimed)
+                raise
+
+    def _get_pusher(self, payload):
+        """Return the name of the user who pushed, if the payload has it."""
+        pusher = payload.values.get('pusher')
+        if isinstance(pusher, dict):
+            return pusher.get('name') or None
+        return None
+
+    def _get_trac_reponame(self, reponame):
+        """Return the Trac repository matching a GitHub repository name,
+        the default repository if none has that name."""
+        if reponame in RepositoryManager(self.env).get_all_repositories():
+            return reponame
+        return ''
+
+    def _get_repository_dir(self, reponame):
+        info = RepositoryManager(self.env).get_all_repositories().get(reponame, {})
+        repodir = info.get('dir') or RepositoryManager(self.env).repository_dir
+        if not os.path.isabs(repodir):
+            repodir = os.path.join(self.env.path, repodir)
+        return repodir
+
+    @timed('git_fetch')
+    def _fetch_repository(self, reponame):
+        """Fetch a Trac repository from GitHub and resync it."""
+        repodir = self._get_repository_dir(reponame)
+        self.env.log.debug("Autofetching: %s", repodir)
+        from git import Git
+        repo = Git(repodir)
+
+        try:
+            self.env.log.debug("Fetching repo %s", reponame or '(default)')
+            repo.execute(['git', 'fetch'])
+            try:
+                self.env.log.debug("Resyncing local repo")
+                self.env.get_repository(reponame).sync()
+            except Exception:
+                self.env.log.error("git sync failed!")
+        except Exception:
+            self.env.log.error("git fetch failed!")
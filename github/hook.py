@@ -56,23 +56,27 @@
 #
 # pylint: disable-msg=C0301, C0111
 
-import re
 import sys
+import time
 from datetime import datetime
+from trac.resource import ResourceNotFound
 from trac.ticket.notification import TicketNotifyEmail
 from trac.ticket import Ticket
-from trac.ticket.web_ui import TicketModule
-# TODO: move grouped_changelog_entries to model.py
-from trac.util.datefmt import utc
+from trac.util.datefmt import utc, to_utimestamp
 
-ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
-ticket_reference = ticket_prefix + '[0-9]+'
-ticket_command =  (r'(?P<action>[A-Za-z]*).?'
-                   '(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
-                   (ticket_reference, ticket_reference))
+from commands import CommandParser
+from locks import KeyedLocks
+from stats import Metrics, timed
+
+# attempts at saving the changes of a commit or push, and seconds to wait
+# before the second one
+SAVE_ATTEMPTS = 3
+RETRY_DELAY = 0.05
+
+
+class TicketConflict(Exception):
+    """A ticket was changed by someone else while the hook updated it."""
 
-command_re = re.compile(ticket_command)
-ticket_re = re.compile(ticket_prefix + '([0-9]+)')
 
 class CommitHook:
     _supported_cmds = {'close':      '_cmdClose',
@@ -91,70 +95,230 @@ class CommitHook:
                        'returns':    '_cmdReturns'}
 
 
-    def __init__(self, env):
+    def __init__(self, env, revmap_inserted=None, commands=None, metrics=None, outbox=None,
+                 ledger=None):
         self.env = env
+        self.revmap_inserted = revmap_inserted
+        self.outbox = outbox
+        self.ledger = ledger
+        self.metrics = metrics or Metrics()
+        self.locks = KeyedLocks()
+        if commands is None:
+            commands = self.__class__._supported_cmds
+        self.parser = CommandParser(commands)
 
     def process(self, commit, status, enable_revmap, reponame):
-        self.closestatus = status
-
-        msg = commit['message']
-        self.env.log.debug("Processing Commit: %s", msg)
-        msg = '(In [%s %s]) %s' % (commit['url'], commit['id'][:10], msg)
+        msg = self._format_message(commit)
         author = commit['author']['name']
-        timestamp = datetime.now(utc)
         if int(enable_revmap):
-            self.env.log.debug("adding commit %s to revmap", commit['id'])
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute("INSERT INTO svn_revmap (svn_rev, git_hash, commit_msg) VALUES (0, %s, %s);",
-                    (commit['id'], commit['message']))
-            db.commit()
+            self._add_to_revmap(commit)
 
-        cmd_groups = command_re.findall(msg)
-        self.env.log.debug("Function Handlers: %s" % cmd_groups)
+        done = (reponame, [commit['id']])
+        tickets = self._parse_commands(msg)
+        if not tickets:
+            self._record_done(done)
+            return
 
-        tickets = {}
-        for cmd, tkts in cmd_groups:
-            funcname = self.__class__._supported_cmds.get(cmd.lower(), '')
-            self.env.log.debug("Function Handler: %s" % funcname)
-            if funcname:
-                for tkt_id in ticket_re.findall(tkts):
-                    func = getattr(self, funcname)
-                    tickets.setdefault(tkt_id, []).append(func)
-
-        for tkt_id, cmds in tickets.iteritems():
+        #all the tickets of a commit are updated, or none is
+        updated, timestamp = self._save_tickets([(tkt_id, cmds, author, msg)
+                                                 for tkt_id, cmds in tickets.iteritems()],
+                                                status, done)
+        for ticket in updated:
             try:
-                db = self.env.get_db_cnx()
-
-                ticket = Ticket(self.env, int(tkt_id), db)
-                for cmd in cmds:
-                    cmd(ticket)
+                self._notify(ticket, timestamp)
+            except Exception:
+                import traceback
+                traceback.print_exc(file=sys.stderr)
 
-                # determine sequence number...
-                cnum = 0
-                tm = TicketModule(self.env)
-                for change in tm.grouped_changelog_entries(ticket, db):
-                    if change['permanent']:
-                        cnum += 1
+    def process_push(self, commits, status, enable_revmap, reponame, pusher=None):
+        """Process all the commits of a push at once: the commands of every
+        commit are applied in order, and each referenced ticket gets a
+        single change holding all the commit messages and a single
+        notification. The change is made by `pusher`, or by the author of
+        the last commit referencing the ticket; the comment names the
+        authors of the commits when there are others."""
+        tickets = {}
+        order = []
+        done = (reponame, [])
+        for commit in commits:
+            done[1].append(commit['id'])
+            msg = self._format_message(commit)
+            if int(enable_revmap):
+                self._add_to_revmap(commit)
+            for tkt_id, cmds in self._parse_commands(msg).iteritems():
+                if tkt_id not in tickets:
+                    tickets[tkt_id] = ([], [], [])
+                    order.append(tkt_id)
+                all_cmds, msgs, authors = tickets[tkt_id]
+                all_cmds.extend(cmds)
+                msgs.append(msg)
+                if commit['author']['name'] in authors:
+                    authors.remove(commit['author']['name'])
+                authors.append(commit['author']['name'])
 
-                ticket.save_changes(author, msg, timestamp, db, cnum+1)
-                db.commit()
+        changes = []
+        for tkt_id in order:
+            all_cmds, msgs, authors = tickets[tkt_id]
+            author = pusher or authors[-1]
+            if authors != [author]:
+                msgs = ['Commits by %s:' % ', '.join(authors)] + msgs
+            changes.append((tkt_id, all_cmds, author, '\n\n'.join(msgs)))
+        if not changes:
+            self._record_done(done)
+            return
+        updated, timestamp = self._save_tickets(changes, status, done)
 
-                tn = TicketNotifyEmail(self.env)
-                tn.notify(ticket, newticket=0, modtime=timestamp)
+        for ticket in updated:
+            try:
+                self._notify(ticket, timestamp)
             except Exception:
                 import traceback
                 traceback.print_exc(file=sys.stderr)
-                #print>>sys.stderr, 'Unexpected error while processing ticket ' \
-                                   #'ID %s: %s' % (tkt_id, e)
+
+    def _format_message(self, commit):
+        msg = commit['message']
+        self.env.log.debug("Processing Commit: %s", msg)
+        self.metrics.incr('commits')
+        return '(In [%s %s]) %s' % (commit['url'], commit['id'][:10], msg)
+
+    def _add_to_revmap(self, commit):
+        self.env.log.debug("adding commit %s to revmap", commit['id'])
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        #already there when a payload that failed is processed again
+        cursor.execute("SELECT 1 FROM svn_revmap WHERE svn_rev=0 AND git_hash=%s", (commit['id'],))
+        if cursor.fetchone():
+            return
+        cursor.execute("INSERT INTO svn_revmap (svn_rev, git_hash, commit_msg) VALUES (0, %s, %s);",
+                (commit['id'], commit['message']))
+        db.commit()
+        if self.revmap_inserted:
+            self.revmap_inserted(commit['id'])
+
+    def _parse_commands(self, msg):
+        """Return the command handlers found in a commit message, by
+        ticket id."""
+        commands = self.parser.parse(msg)
+        self.env.log.debug("Function Handlers: %s", commands)
+
+        tickets = {}
+        funcs = {}
+        for tkt_id, funcname in commands:
+            if funcname not in funcs:
+                funcs[funcname] = getattr(self, funcname)
+            tickets.setdefault(tkt_id, []).append(funcs[funcname])
+        return tickets
+
+    def _record_done(self, done):
+        """Record the `(reponame, commit_ids)` commits of `done` as
+        processed in the ledger."""
+        if self.ledger is None or not done[1]:
+            return
+        db = self.env.get_db_cnx()
+        try:
+            self.ledger.done(done[0], done[1], db)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+    def _save_tickets(self, changes, status, done=None):
+        """Apply `(tkt_id, cmds, author, msg)` changes in one transaction
+        and return the updated tickets and the time of the change. The
+        `(reponame, commit_ids)` commits of `done` are recorded as processed
+        in the ledger in the same transaction.
+
+        Threads of this process saving changes to the same tickets take
+        turns; a ticket changed meanwhile by another process makes the
+        transaction start over, with the ticket as it now is.
+        """
+        tkt_ids = self.locks.acquire([int(change[0]) for change in changes])
+        try:
+            for attempt in xrange(1, SAVE_ATTEMPTS + 1):
+                timestamp = datetime.now(utc)
+                db = self.env.get_db_cnx()
+                updated = []
+                try:
+                    for tkt_id, cmds, author, msg in changes:
+                        try:
+                            updated.append(self._update_ticket(tkt_id, cmds, status, author,
+                                                               msg, timestamp, db))
+                        except ResourceNotFound:
+                            self.env.log.warning("commit references missing ticket #%s", tkt_id)
+                    if self.outbox is not None:
+                        for ticket in updated:
+                            self.outbox.add(ticket.id, timestamp, db)
+                    if self.ledger is not None and done:
+                        self.ledger.done(done[0], done[1], db)
+                    db.commit()
+                    if self.outbox is not None and updated:
+                        self.outbox.wake()
+                    return updated, timestamp
+                except TicketConflict, e:
+                    db.rollback()
+                    if attempt == SAVE_ATTEMPTS:
+                        raise
+                    self.metrics.incr('ticket_conflicts')
+                    self.env.log.info("saving tickets %s failed (%s), retrying",
+                                      ', '.join(map(str, tkt_ids)), e)
+                    time.sleep(RETRY_DELAY * attempt)
+                except:
+                    db.rollback()
+                    raise
+        finally:
+            self.locks.release(tkt_ids)
+
+    @timed('ticket_save')
+    def _update_ticket(self, tkt_id, cmds, status, author, msg, timestamp, db):
+        """Apply the commands to a ticket and save it with the commit
+        message as comment, without committing. Raises `TicketConflict` if
+        the ticket changed since it was read."""
+        ticket = Ticket(self.env, int(tkt_id), db)
+        changetime = ticket.time_changed
+        for cmd in cmds:
+            cmd(ticket, status)
+
+        #sets the changetime save_changes() sets, if the ticket is as it was
+        #read, locking its row until the transaction ends; the row changes,
+        #so rowcount is right even on MySQL, which counts changed rows only
+        cursor = db.cursor()
+        cursor.execute("UPDATE ticket SET changetime=%s WHERE id=%s AND changetime=%s",
+                (to_utimestamp(timestamp), ticket.id, to_utimestamp(changetime)))
+        if cursor.rowcount != 1:
+            raise TicketConflict("ticket #%s changed while being updated" % ticket.id)
+        ticket.save_changes(author, msg, timestamp, db, self._next_cnum(ticket, db))
+        return ticket
+
+    def _notify(self, ticket, timestamp):
+        if self.outbox is not None:
+            #queued with the change by _save_tickets
+            return
+        self._send_notification(ticket, timestamp)
+
+    @timed('ticket_notify')
+    def _send_notification(self, ticket, timestamp):
+        tn = TicketNotifyEmail(self.env)
+        tn.notify(ticket, newticket=0, modtime=timestamp)
+
+    def _next_cnum(self, ticket, db):
+        """Return the number of the next comment on a ticket.
+
+        `TicketModule.grouped_changelog_entries` numbers each group of
+        changes saved at the same time, so this counts the distinct change
+        times instead of walking the whole changelog.
+        """
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(DISTINCT time) FROM ticket_change WHERE ticket=%s",
+                (ticket.id,))
+        return cursor.fetchone()[0] + 1
 
 
-    def _cmdClose(self, ticket):
-        ticket['status'] = self.closestatus
+    def _cmdClose(self, ticket, status):
+        ticket['status'] = status
         ticket['resolution'] = 'fixed'
 
-    def _cmdRefs(self, ticket):
+    def _cmdRefs(self, ticket, status):
         pass
 
-    def _cmdReturns(self, ticket):
+    def _cmdReturns(self, ticket, status):
         ticket['owner'] = ticket['reporter']
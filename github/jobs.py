@@ -0,0 +1,189 @@
+""" Job queue
+"""
+# pylint: disable-msg=C0301, C0111
+
+import sys
+import time
+import threading
+import weakref
+import traceback
+from collections import deque
+
+from trac.db import Table, Column, Index
+
+# number of recent queue latencies kept for the statistics
+LATENCY_SAMPLES = 100
+
+
+class HookQueue(object):
+    """A queue of GitHub post-receive payloads kept in the `github_queue`
+    table, so that the webhook can answer at once and the commits are
+    processed by a background thread, or by `trac-admin <env> github drain`.
+
+    `process` is called with the payload of each job. The background
+    thread doesn't touch the queue until `ready`, if given, returns true.
+    """
+
+    SCHEMA = [
+            Table('github_queue', key = 'id')[
+                Column('id', auto_increment=True),
+                Column('reponame'),
+                Column('payload'),
+                Column('status'),
+                Column('enqueued', type='int64'),
+                Column('started', type='int64'),
+                Column('error'),
+                Index(['status', 'id']),
+                ]
+            ]
+
+    def __init__(self, env, process, poll_interval=10, stale_timeout=3600, ready=None):
+        self.env = env
+        self.process = process
+        self.ready = ready
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self.processed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def enqueue(self, reponame, payload):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO github_queue (reponame, payload, status, enqueued) VALUES (%s, %s, 'pending', %s)",
+                (reponame, payload, _now()))
+        db.commit()
+        self.start_worker()
+        self._wakeup.set()
+
+    def depth(self):
+        """Return the number of jobs by status."""
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM github_queue GROUP BY status")
+        return dict(cursor)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        stats = {'processed': self.processed,
+                 'failed': self.failed,
+                 'depth': self.depth(),
+                 'latency_avg': None,
+                 'latency_max': None}
+        if latencies:
+            stats['latency_avg'] = sum(latencies) / len(latencies)
+            stats['latency_max'] = latencies[-1]
+        return stats
+
+    def run_one(self):
+        """Claim the oldest pending job and process it. Returns False when
+        there was nothing to do."""
+        job = self._claim()
+        if job is None:
+            return False
+        job_id, reponame, payload, enqueued = job
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        try:
+            self.process(payload)
+        except Exception:
+            self.failed += 1
+            self.env.log.error("GitHub hook job %d failed: %s", job_id, traceback.format_exc())
+            cursor.execute("UPDATE github_queue SET status='failed', error=%s WHERE id=%s",
+                    (traceback.format_exc(), job_id))
+        else:
+            self.processed += 1
+            cursor.execute("DELETE FROM github_queue WHERE id=%s", (job_id,))
+        db.commit()
+        self.latencies.append((_now() - enqueued) / 1000000.0)
+        return True
+
+    def drain(self):
+        """Process jobs until the queue is empty, returning their number."""
+        count = 0
+        while self.run_one():
+            count += 1
+        return count
+
+    def retry_failed(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("UPDATE github_queue SET status='pending', error=NULL WHERE status='failed'")
+        db.commit()
+
+    def start_worker(self):
+        self._lock.acquire()
+        try:
+            if self._worker is None or not self._worker.isAlive():
+                self._worker = threading.Thread(target=run_worker, name='github-hook-worker',
+                                                args=(weakref.ref(self), self._wakeup))
+                self._worker.setDaemon(True)
+                self._worker.start()
+        finally:
+            self._lock.release()
+
+    def poll(self):
+        """Process the pending jobs, returning the seconds to wait before
+        the next poll."""
+        self.drain()
+        return self.poll_interval
+
+    def _claim(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        #jobs left running by a worker that died are picked up again
+        cursor.execute("SELECT id, reponame, payload, enqueued FROM github_queue "
+                       "WHERE status='pending' OR (status='running' AND started < %s) ORDER BY id",
+                       (_now() - self.stale_timeout * 1000000,))
+        for row in cursor.fetchmany(10):
+            claim = db.cursor()
+            claim.execute("UPDATE github_queue SET status='running', started=%s "
+                          "WHERE id=%s AND (status='pending' OR (status='running' AND started < %s))",
+                          (_now(), row[0], _now() - self.stale_timeout * 1000000))
+            if claim.rowcount == 1:
+                db.commit()
+                return row
+        db.commit()
+        return None
+
+
+def run_worker(ref, wakeup):
+    """Call the `poll()` of the object `ref` refers to until `wakeup` is set
+    or the seconds it returns have passed, and again, until the object is
+    garbage collected or its environment is shut down. Trac creates a new
+    environment, with new components, whenever trac.ini changes, and the
+    thread of the previous ones must not keep them alive. Until the
+    object's `ready()` returns true, it just waits.
+    """
+    ready = False
+    while True:
+        worker = ref()
+        if worker is None or env_is_shut_down(worker.env):
+            return
+        wakeup.clear()
+        try:
+            if not ready:
+                ready = worker.ready is None or worker.ready()
+            if ready:
+                interval = worker.poll()
+            else:
+                interval = worker.poll_interval
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            interval = worker.poll_interval
+        #the traceback would hold on to the worker
+        sys.exc_clear()
+        del worker
+        wakeup.wait(interval)
+
+
+def env_is_shut_down(env):
+    """Return whether `Environment.shutdown()` was called on `env`, which
+    removes the log handler the environment set up."""
+    return not hasattr(env, '_log_handler')
+
+
+def _now():
+    return long(time.time() * 1000000)
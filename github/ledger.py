@@ -0,0 +1,169 @@
+""" Commit ledger
+"""
+# pylint: disable-msg=C0301, C0111
+
+import time
+
+from trac.db import Table, Column, Index
+
+# number of commit ids looked up per query
+QUERY_CHUNK_SIZE = 100
+# seconds between two prunings of the ledger by a process
+PRUNE_INTERVAL = 3600
+# seconds after which the claims of a process that died while processing
+# the commits are ignored; shorter than the stale timeout of the hook
+# queue, so that a job picked up again finds the claims of its commits stale
+STALE_TIMEOUT = 1800
+
+
+class CommitLedger(object):
+    """Remembers the commits the hook has processed, by repository, in the
+    `github_commits` table, so that payloads redelivered by GitHub don't
+    comment on tickets twice. Entries older than `retention_days` are
+    pruned.
+
+    Commits are claimed in the `github_claims` table before being
+    processed, so that concurrent deliveries of a payload don't both
+    process them, and recorded as processed by `done()`, in the
+    transaction saving their ticket changes. The claims of commits that
+    couldn't be processed are `release()`d, or ignored once older than
+    `stale_timeout` seconds when the process died.
+    """
+
+    SCHEMA = [
+            Table('github_commits', key = ('reponame', 'commit_id'))[
+                Column('reponame'),
+                Column('commit_id'),
+                Column('time', type='int64'),
+                Index(['time']),
+                ]
+            ]
+
+    CLAIMS_SCHEMA = [
+            Table('github_claims', key = ('reponame', 'commit_id'))[
+                Column('reponame'),
+                Column('commit_id'),
+                Column('started', type='int64'),
+                Index(['started']),
+                ]
+            ]
+
+    def __init__(self, env, retention_days=90, stale_timeout=STALE_TIMEOUT):
+        self.env = env
+        self.retention_days = retention_days
+        self.stale_timeout = stale_timeout
+        self.skipped = 0
+        self._last_prune = 0
+
+    def claim(self, reponame, commits, claimed=None):
+        """Claim the commits of a payload and yield those that weren't
+        processed or claimed already, in order, reading `commits` by
+        chunks. The ids of the claimed commits are appended to `claimed`,
+        for the caller to `release()` them if processing fails."""
+        if time.time() - self._last_prune > PRUNE_INTERVAL:
+            self.prune()
+        seen = set()
+        chunk = []
+        for commit in commits:
+            chunk.append(commit)
+            if len(chunk) >= QUERY_CHUNK_SIZE:
+                for commit in self._claim_chunk(reponame, chunk, seen, claimed):
+                    yield commit
+                chunk = []
+        for commit in self._claim_chunk(reponame, chunk, seen, claimed):
+            yield commit
+
+    def done(self, reponame, commit_ids, db):
+        """Record claimed commits as processed, in the transaction `db`,
+        without committing."""
+        processed = self._get_ids(db, 'github_commits', reponame, commit_ids)
+        now = _now()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO github_commits (reponame, commit_id, time) VALUES (%s, %s, %s)",
+                [(reponame, commit_id, now) for commit_id in set(commit_ids)
+                 if commit_id not in processed])
+        self._delete_claims(db, reponame, commit_ids)
+
+    def release(self, reponame, commit_ids):
+        """Drop the claims of commits that weren't processed, so that the
+        next delivery of their payload processes them."""
+        db = self.env.get_db_cnx()
+        self._delete_claims(db, reponame, commit_ids)
+        db.commit()
+
+    def _claim_chunk(self, reponame, commits, seen, claimed):
+        if not commits:
+            return []
+        db = self.env.get_db_cnx()
+        commit_ids = [commit['id'] for commit in commits]
+        for attempt in (1, 2):
+            #claims left by a process that died while processing the commits
+            self._delete_claims(db, reponame, commit_ids,
+                                _now() - self.stale_timeout * 1000000)
+            taken = self._get_ids(db, 'github_commits', reponame, commit_ids) | \
+                    self._get_ids(db, 'github_claims', reponame, commit_ids)
+            new_commits = []
+            new_ids = set()
+            for commit in commits:
+                if commit['id'] not in taken and commit['id'] not in seen \
+                        and commit['id'] not in new_ids:
+                    new_ids.add(commit['id'])
+                    new_commits.append(commit)
+            now = _now()
+            try:
+                cursor = db.cursor()
+                cursor.executemany("INSERT INTO github_claims (reponame, commit_id, started) VALUES (%s, %s, %s)",
+                        [(reponame, commit['id'], now) for commit in new_commits])
+                db.commit()
+                break
+            except Exception:
+                #another delivery claimed some of these commits meanwhile
+                db.rollback()
+                if attempt == 2:
+                    raise
+        seen.update(new_ids)
+        if claimed is not None:
+            claimed.extend([commit['id'] for commit in new_commits])
+        self.skipped += len(commits) - len(new_commits)
+        if len(new_commits) < len(commits):
+            self.env.log.info("skipping %d already processed commits of %s",
+                              len(commits) - len(new_commits), reponame)
+        return new_commits
+
+    def prune(self):
+        """Forget the commits processed more than `retention_days` ago."""
+        self._last_prune = time.time()
+        if self.retention_days <= 0:
+            return
+        limit = long((time.time() - self.retention_days * 86400) * 1000000)
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM github_commits WHERE time < %s", (limit,))
+        cursor.execute("DELETE FROM github_claims WHERE started < %s", (limit,))
+        db.commit()
+
+    def _get_ids(self, db, table, reponame, commit_ids):
+        cursor = db.cursor()
+        ids = set()
+        for i in xrange(0, len(commit_ids), QUERY_CHUNK_SIZE):
+            chunk = commit_ids[i:i + QUERY_CHUNK_SIZE]
+            cursor.execute("SELECT commit_id FROM %s WHERE reponame=%%s AND commit_id IN (%s)"
+                    % (table, ','.join(['%s'] * len(chunk))), [reponame] + chunk)
+            ids.update(row[0] for row in cursor)
+        return ids
+
+    def _delete_claims(self, db, reponame, commit_ids, before=None):
+        cursor = db.cursor()
+        for i in xrange(0, len(commit_ids), QUERY_CHUNK_SIZE):
+            chunk = commit_ids[i:i + QUERY_CHUNK_SIZE]
+            query = "DELETE FROM github_claims WHERE reponame=%%s AND commit_id IN (%s)" \
+                    % ','.join(['%s'] * len(chunk))
+            args = [reponame] + chunk
+            if before is not None:
+                query += " AND started < %s"
+                args.append(before)
+            cursor.execute(query, args)
+
+
+def _now():
+    return long(time.time() * 1000000)
@@ -0,0 +1,48 @@
+""" Keyed locks
+"""
+# pylint: disable-msg=C0301, C0111
+
+import threading
+
+
+class KeyedLocks(object):
+    """A lock per key, created on first use and dropped once no thread holds
+    or waits for it, so that threads working on different keys don't wait
+    for each other. Several keys are always locked in sorted order, so two
+    threads locking overlapping sets of keys can't deadlock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def acquire(self, keys):
+        """Lock the keys and return them sorted, to be passed to
+        `release()`."""
+        keys = sorted(set(keys))
+        for key in keys:
+            self._lock.acquire()
+            try:
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [threading.Lock(), 0]
+                entry[1] += 1
+            finally:
+                self._lock.release()
+            entry[0].acquire()
+        return keys
+
+    def release(self, keys):
+        for key in reversed(keys):
+            self._lock.acquire()
+            try:
+                entry = self._locks[key]
+                entry[0].release()
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+            finally:
+                self._lock.release()
+
+    def __len__(self):
+        return len(self._locks)
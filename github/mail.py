@@ -0,0 +1,81 @@
+""" Batched SMTP sender
+"""
+# pylint: disable-msg=C0301, C0111
+
+import time
+import smtplib
+import threading
+
+from trac.core import TracError
+from trac.notification import SmtpEmailSender
+from trac.util.text import CRLF, fix_eol
+from trac.util.translation import _
+
+
+class BatchSmtpEmailSender(SmtpEmailSender):
+    """SMTP e-mail sender reusing one connection for all the messages sent
+    by a thread between `open_batch()` and `close_batch()`, as the GitHub
+    notification outbox does; messages sent outside a batch get their own
+    connection, like with `SmtpEmailSender`. Enable it with:
+
+        [notification]
+        email_sender = BatchSmtpEmailSender
+    """
+
+    _local = threading.local()
+
+    def open_batch(self):
+        self._local.batch = True
+
+    def close_batch(self):
+        server = getattr(self._local, 'server', None)
+        self._local.batch = False
+        self._local.server = None
+        if server is not None:
+            self._quit(server)
+
+    def send(self, from_addr, recipients, message):
+        if not getattr(self._local, 'batch', False):
+            return SmtpEmailSender.send(self, from_addr, recipients, message)
+        message = fix_eol(message, CRLF)
+        self.log.info("Sending notification through SMTP at %s:%d to %s",
+                      self.smtp_server, self.smtp_port, recipients)
+        server = getattr(self._local, 'server', None)
+        if server is not None:
+            try:
+                server.rset()
+            except smtplib.SMTPException:
+                #the server dropped the connection, open another one
+                server = None
+        if server is None:
+            server = self._local.server = self._connect()
+        start = time.time()
+        try:
+            server.sendmail(from_addr, recipients, message)
+        except Exception:
+            self._local.server = None
+            self._quit(server)
+            raise
+        t = time.time() - start
+        if t > 5:
+            self.log.warning("Slow mail submission (%.2f s), check your mail setup", t)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        if self.use_tls:
+            server.ehlo()
+            if not server.has_extn('starttls'):
+                raise TracError(_("TLS enabled but server does not support TLS"))
+            server.starttls()
+            server.ehlo()
+        if self.smtp_user:
+            server.login(self.smtp_user.encode('utf-8'),
+                         self.smtp_password.encode('utf-8'))
+        return server
+
+    def _quit(self, server):
+        try:
+            server.quit()
+        except Exception:
+            #with TLS, some servers close the connection without answering
+            pass
@@ -0,0 +1,235 @@
+""" Notification outbox
+"""
+# pylint: disable-msg=C0301, C0111
+
+import time
+import weakref
+import threading
+import traceback
+
+from trac.db import Table, Column, Index
+from trac.resource import ResourceNotFound
+from trac.util.datefmt import from_utimestamp, to_utimestamp
+
+from jobs import run_worker
+from stats import Metrics, timed
+
+
+class NotificationOutbox(object):
+    """Ticket notifications kept in the `github_outbox` table and sent by a
+    background thread, or by `trac-admin <env> github notify`, so that a
+    slow mail relay doesn't hold up the processing of commits.
+
+    A ticket's notification is sent `window` seconds after its first
+    pending change, and covers all the changes to the ticket queued
+    meanwhile. The notifications due at once are sent as a batch, over a
+    single SMTP connection when the `email_sender` is
+    `BatchSmtpEmailSender`. The background thread doesn't touch the outbox
+    until `ready`, if given, returns true.
+    """
+
+    SCHEMA = [
+            Table('github_outbox', key = 'id')[
+                Column('id', auto_increment=True),
+                Column('ticket', type='int'),
+                Column('modtime', type='int64'),
+                Column('queued', type='int64'),
+                Column('status'),
+                Column('started', type='int64'),
+                Column('error'),
+                Index(['status', 'ticket']),
+                ]
+            ]
+
+    def __init__(self, env, window=60, poll_interval=10, stale_timeout=3600, metrics=None, ready=None):
+        self.env = env
+        self.ready = ready
+        self.window = window
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self.metrics = metrics or Metrics()
+        self.sent = 0
+        self.failed = 0
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def add(self, tkt_id, modtime, db):
+        """Queue the notification of a ticket change, in the transaction
+        saving the change; `wake()` once it is committed."""
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO github_outbox (ticket, modtime, queued, status) VALUES (%s, %s, %s, 'pending')",
+                (tkt_id, to_utimestamp(modtime), _now()))
+
+    def wake(self):
+        self.start_worker()
+        self._wakeup.set()
+
+    def depth(self):
+        """Return the number of queued changes by status."""
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM github_outbox GROUP BY status")
+        return dict(cursor)
+
+    def stats(self):
+        return {'sent': self.sent,
+                'failed': self.failed,
+                'depth': self.depth()}
+
+    def flush(self, force=False):
+        """Send the notifications that are due, or all of them if `force`
+        is set, returning their number."""
+        tkt_ids = self._get_due_tickets(force)
+        if not tkt_ids:
+            return 0
+        from trac.notification import NotificationSystem
+        sender = NotificationSystem(self.env).email_sender
+        batch = hasattr(sender, 'open_batch')
+        if batch:
+            sender.open_batch()
+        count = 0
+        try:
+            for tkt_id in tkt_ids:
+                claimed = self._claim(tkt_id)
+                if claimed:
+                    self._send(tkt_id, claimed)
+                    count += 1
+        finally:
+            if batch:
+                sender.close_batch()
+        return count
+
+    def retry_failed(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("UPDATE github_outbox SET status='pending', error=NULL WHERE status='failed'")
+        db.commit()
+
+    def start_worker(self):
+        self._lock.acquire()
+        try:
+            if self._worker is None or not self._worker.isAlive():
+                self._worker = threading.Thread(target=run_worker, name='github-notification-sender',
+                                                args=(weakref.ref(self), self._wakeup))
+                self._worker.setDaemon(True)
+                self._worker.start()
+        finally:
+            self._lock.release()
+
+    def poll(self):
+        """Send the notifications that are due, returning the seconds to
+        wait before the next poll."""
+        self.flush()
+        return min(self.poll_interval, max(self.window, 1))
+
+    def _get_due_tickets(self, force):
+        cursor = self.env.get_db_cnx().cursor()
+        now = _now()
+        cursor.execute("SELECT ticket, MIN(queued) FROM github_outbox "
+                       "WHERE status='pending' OR (status='sending' AND started < %s) "
+                       "GROUP BY ticket ORDER BY MIN(queued)",
+                       (now - self.stale_timeout * 1000000,))
+        return [tkt_id for tkt_id, queued in cursor
+                if force or queued <= now - self.window * 1000000]
+
+    def _claim(self, tkt_id):
+        """Claim the queued changes of a ticket, returning their
+        `(id, modtime)`, or nothing if another thread or process claimed
+        them first."""
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        stale = _now() - self.stale_timeout * 1000000
+        cursor.execute("SELECT id, modtime FROM github_outbox WHERE ticket=%s "
+                       "AND (status='pending' OR (status='sending' AND started < %s)) ORDER BY modtime",
+                       (tkt_id, stale))
+        rows = cursor.fetchall()
+        if not rows:
+            return []
+        cursor.execute("UPDATE github_outbox SET status='sending', started=%%s WHERE id IN (%s) "
+                       "AND (status='pending' OR (status='sending' AND started < %%s))"
+                       % ','.join(['%s'] * len(rows)),
+                       [_now()] + [row[0] for row in rows] + [stale])
+        if cursor.rowcount != len(rows):
+            db.rollback()
+            return []
+        db.commit()
+        return rows
+
+    @timed('ticket_notify')
+    def _send(self, tkt_id, claimed):
+        from trac.ticket import Ticket
+        from trac.ticket.notification import TicketNotifyEmail
+        ids = [row[0] for row in claimed]
+        modtimes = sorted(set([row[1] for row in claimed]))
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        try:
+            ticket = Ticket(self.env, tkt_id, db)
+            if len(modtimes) > 1:
+                ticket = CoalescedTicket(ticket, modtimes)
+            TicketNotifyEmail(self.env).notify(ticket, newticket=0,
+                                               modtime=from_utimestamp(modtimes[-1]))
+        except ResourceNotFound:
+            #deleted since
+            pass
+        except Exception:
+            self.failed += 1
+            self.env.log.error("notification of ticket #%s failed: %s", tkt_id, traceback.format_exc())
+            cursor.execute("UPDATE github_outbox SET status='failed', error=%%s WHERE id IN (%s)"
+                           % ','.join(['%s'] * len(ids)), [traceback.format_exc()] + ids)
+            db.commit()
+            return
+        self.sent += 1
+        cursor.execute("DELETE FROM github_outbox WHERE id IN (%s)"
+                       % ','.join(['%s'] * len(ids)), ids)
+        db.commit()
+
+
+class CoalescedTicket(object):
+    """A ticket whose changelog holds, at the last of `modtimes`, a single
+    change summing up its changes at each of `modtimes`: comments are
+    joined and each field goes from its first old value to its last new
+    one. Given to `TicketNotifyEmail`, it makes one message out of several
+    changes.
+    """
+
+    def __init__(self, ticket, modtimes):
+        self._ticket = ticket
+        self._modtimes = modtimes
+
+    def __getattr__(self, name):
+        return getattr(self._ticket, name)
+
+    def __getitem__(self, name):
+        return self._ticket[name]
+
+    def __contains__(self, name):
+        return name in self._ticket
+
+    def get_changelog(self, when=None, db=None):
+        fields = {}
+        order = []
+        comments = []
+        comment = None
+        for modtime in self._modtimes:
+            for date, author, field, old, new, permanent in \
+                    self._ticket.get_changelog(when=from_utimestamp(modtime), db=db):
+                if field == 'comment':
+                    comment = (author, old)
+                    if new:
+                        comments.append(new)
+                elif field in fields:
+                    fields[field][2] = new
+                else:
+                    fields[field] = [author, old, new]
+                    order.append(field)
+        when = from_utimestamp(self._modtimes[-1])
+        changelog = [(when, fields[field][0], field, fields[field][1], fields[field][2], True)
+                     for field in order]
+        if comment is not None:
+            changelog.append((when, comment[0], 'comment', comment[1], '\n\n'.join(comments), True))
+        return changelog
+
+
+def _now():
+    return long(time.time() * 1000000)
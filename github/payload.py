@@ -0,0 +1,87 @@
+""" Payload
+"""
+# pylint: disable-msg=C0301, C0111
+
+import re
+
+whitespace_re = re.compile(r'\s*')
+# the tokens that matter when skipping over a JSON value
+skip_re = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+
+class PushPayload(object):
+    """A GitHub post-receive payload decoded one commit at a time.
+
+    The top-level values other than `commits` are decoded up front,
+    `commits` is only scanned for its position so that `iter_commits()`
+    can decode the commits lazily; a push of thousands of commits is
+    never held in memory as a whole list of dicts.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.values = {}
+        #imported here, processes that never receive a payload don't need it
+        import simplejson
+        self._decoder = simplejson.JSONDecoder()
+        self._commits_at = None
+        self._scan()
+
+    @property
+    def repository(self):
+        return self.values['repository']
+
+    def iter_commits(self):
+        if self._commits_at is None:
+            return
+        idx = self._expect(self._commits_at, '[')
+        if self.data[idx:idx + 1] == ']':
+            return
+        while True:
+            commit, idx = self._decoder.raw_decode(self.data, idx)
+            yield commit
+            idx = self._skip_ws(idx)
+            if self.data[idx:idx + 1] == ']':
+                return
+            idx = self._expect(idx, ',')
+
+    def _scan(self):
+        data = self.data
+        idx = self._expect(self._skip_ws(0), '{')
+        if data[idx:idx + 1] == '}':
+            return
+        while True:
+            key, idx = self._decoder.raw_decode(data, idx)
+            idx = self._expect(self._skip_ws(idx), ':')
+            if key == 'commits':
+                self._commits_at = idx
+                idx = self._skip_value(idx)
+            else:
+                self.values[key], idx = self._decoder.raw_decode(data, idx)
+            idx = self._skip_ws(idx)
+            if data[idx:idx + 1] == '}':
+                return
+            idx = self._expect(idx, ',')
+
+    def _skip_ws(self, idx):
+        return whitespace_re.match(self.data, idx).end()
+
+    def _expect(self, idx, char):
+        if self.data[idx:idx + 1] != char:
+            raise ValueError("expected '%s' at offset %d of the payload" % (char, idx))
+        return self._skip_ws(idx + 1)
+
+    def _skip_value(self, idx):
+        """Return the offset following the array or object at `idx`."""
+        if self.data[idx:idx + 1] not in ('[', '{'):
+            return self._decoder.raw_decode(self.data, idx)[1]
+        depth = 0
+        for match in skip_re.finditer(self.data, idx):
+            token = match.group(0)
+            if token in ('[', '{'):
+                depth += 1
+            elif token in (']', '}'):
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        raise ValueError("unterminated value at offset %d of the payload" % idx)
@@ -0,0 +1,54 @@
+""" Revision map
+"""
+# pylint: disable-msg=C0301, C0111
+
+import re
+
+hash_re = re.compile(r'[0-9a-f]{40}')
+svn_id_re = re.compile(r'git-svn-id:.*@(\d+) ')
+
+
+def parse_revmap(revmap_fd):
+    """Yield a `(svn_rev, git_hash, commit_msg)` tuple for each commit of a
+    revision map, one line at a time and newest commit first.
+
+    The map is the output of `git log --format='%H%n%s%n%b'` on a git-svn
+    clone: a hash line, the commit message and its `git-svn-id:` line,
+    separated by blank lines. Message lines are joined with spaces.
+    Parsing stops after r1.
+    """
+    git_hash = None
+    msg_lines = None
+    for line in revmap_fd:
+        line = line.rstrip('\r\n')
+        if git_hash is None:
+            #skip blank lines between commits and make sure this line is the hash
+            if not line:
+                continue
+            if not hash_re.match(line):
+                raise ValueError("expecting hash, found '%s'" % line)
+            git_hash = line
+            msg_lines = None
+        elif line.startswith('git-svn-id:'):
+            svn_id_match = svn_id_re.match(line)
+            if not svn_id_match:
+                raise ValueError("malformed git-svn-id line '%s'" % line)
+            svn_rev = int(svn_id_match.group(1))
+            if msg_lines is None:
+                commit_msg = '<no commit message>'
+            else:
+                commit_msg = ' '.join(msg_lines)
+            yield svn_rev, git_hash, commit_msg.decode('utf-8')
+            if svn_rev == 1:
+                return
+            git_hash = None
+        elif hash_re.match(line):
+            raise ValueError("expected git-svn-id, got '%s'" % line)
+        else:
+            #slurp lines into the commit message until the git-svn-id line
+            if msg_lines is None:
+                msg_lines = []
+            if line:
+                msg_lines.append(line)
+    if git_hash is not None:
+        raise ValueError("revision map ends inside the commit %s" % git_hash)
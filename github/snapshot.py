@@ -0,0 +1,172 @@
+""" Revision map snapshot
+"""
+# pylint: disable-msg=C0301, C0111
+
+import os
+import mmap
+import struct
+import tempfile
+from binascii import hexlify, unhexlify
+
+MAGIC = 'GHRM'
+VERSION = 1
+# magic, version, number of commits, number of svn revisions
+HEADER = struct.Struct('<4sIII')
+# svn revision, offset and length of the message in the blob, by commit
+ENTRY = struct.Struct('<III')
+# svn revision and commit index, by svn revision
+REV = struct.Struct('<II')
+HASH_SIZE = 20
+
+
+def write_snapshot(path, mappings):
+    """Write the `(svn_rev, git_hash, commit_msg)` mappings to a snapshot
+    file, replacing any previous one atomically so that processes reading
+    it keep a consistent view. Hashes that aren't full hex SHA-1s are
+    skipped. Returns the number of commits written."""
+    dirname = os.path.dirname(os.path.abspath(path))
+    blob_fd = tempfile.TemporaryFile(dir=dirname)
+    try:
+        commits = []
+        offset = 0
+        for svn_rev, git_hash, commit_msg in mappings:
+            try:
+                binary = unhexlify(git_hash.lower())
+            except (TypeError, ValueError):
+                continue
+            if len(binary) != HASH_SIZE:
+                continue
+            msg = (commit_msg or u'').encode('utf-8')
+            blob_fd.write(msg)
+            commits.append((binary, svn_rev or 0, offset, len(msg)))
+            offset += len(msg)
+        commits.sort()
+        revs = sorted([(svn_rev, i) for i, (binary, svn_rev, offset, size)
+                       in enumerate(commits) if svn_rev > 0])
+
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.snapshot')
+        out = os.fdopen(fd, 'wb')
+        try:
+            out.write(HEADER.pack(MAGIC, VERSION, len(commits), len(revs)))
+            out.write(''.join([commit[0] for commit in commits]))
+            out.write(''.join([ENTRY.pack(svn_rev, offset, size)
+                               for binary, svn_rev, offset, size in commits]))
+            out.write(''.join([REV.pack(svn_rev, i) for svn_rev, i in revs]))
+            blob_fd.seek(0)
+            while True:
+                chunk = blob_fd.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+            out.close()
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except Exception:
+            out.close()
+            os.remove(tmp_path)
+            raise
+        return len(commits)
+    finally:
+        blob_fd.close()
+
+
+def file_identity(stat):
+    """What tells a snapshot file from the one replacing it."""
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+class RevmapSnapshot(object):
+    """Read-only view of a snapshot written by `write_snapshot()`, mapped in
+    memory so that processes reading the same file share its pages.
+
+    Commits are sorted by hash and svn revisions are indexed separately,
+    both looked up by binary search; messages are only decoded when the
+    `msg` of a result is read.
+    """
+
+    def __init__(self, path):
+        fd = open(path, 'rb')
+        try:
+            self.identity = file_identity(os.fstat(fd.fileno()))
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        magic, version, self.count, self.rev_count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError("%s is not a revision map snapshot" % path)
+        self._hashes = HEADER.size
+        self._entries = self._hashes + self.count * HASH_SIZE
+        self._revs = self._entries + self.count * ENTRY.size
+        self._blob = self._revs + self.rev_count * REV.size
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def lookup_rev(self, svn_rev):
+        """Return the commits of an svn revision."""
+        lo, hi = 0, self.rev_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if REV.unpack_from(self.map, self._revs + mid * REV.size)[0] < svn_rev:
+                lo = mid + 1
+            else:
+                hi = mid
+        commits = []
+        while lo < self.rev_count:
+            rev, i = REV.unpack_from(self.map, self._revs + lo * REV.size)
+            if rev != svn_rev:
+                break
+            commits.append(SnapshotCommit(self, i))
+            lo += 1
+        return commits
+
+    def lookup_prefix(self, prefix, limit=2):
+        """Return at most `limit` commits whose hash starts with the hex
+        string `prefix`."""
+        prefix = prefix.lower()
+        key = unhexlify((prefix + '0' * (HASH_SIZE * 2))[:HASH_SIZE * 2])
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        commits = []
+        while lo < self.count and len(commits) < limit:
+            if not hexlify(self._hash(lo)).startswith(prefix):
+                break
+            commits.append(SnapshotCommit(self, lo))
+            lo += 1
+        return commits
+
+    def _hash(self, i):
+        start = self._hashes + i * HASH_SIZE
+        return self.map[start:start + HASH_SIZE]
+
+    def entry(self, i):
+        """Return the hex hash, svn revision and message of a commit."""
+        svn_rev, offset, size = ENTRY.unpack_from(self.map, self._entries + i * ENTRY.size)
+        start = self._blob + offset
+        return hexlify(self._hash(i)), svn_rev, self.map[start:start + size].decode('utf-8')
+
+
+class SnapshotCommit(dict):
+    """A commit of a snapshot, as a `{'hash', 'msg'}` dict whose message is
+    only read from the snapshot when first looked up."""
+
+    def __init__(self, snapshot, index):
+        dict.__init__(self, hash=hexlify(snapshot._hash(index)))
+        self._snapshot = snapshot
+        self._index = index
+
+    def __missing__(self, key):
+        if key != 'msg':
+            raise KeyError(key)
+        value = self['msg'] = self._snapshot.entry(self._index)[2]
+        return value
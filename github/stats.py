@@ -0,0 +1,109 @@
+""" Metrics
+"""
+# pylint: disable-msg=C0301, C0111
+
+import time
+import random
+import threading
+
+# latencies kept per timer to compute percentiles
+RESERVOIR_SIZE = 1024
+
+
+class _Timing(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+
+class Metrics(object):
+    """Thread-safe counters and timers. Each timer keeps a uniform sample
+    of at most `reservoir_size` of its latencies, from which percentiles
+    are computed, so memory use doesn't grow with the number of calls.
+    """
+
+    def __init__(self, reservoir_size=RESERVOIR_SIZE):
+        self.reservoir_size = reservoir_size
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+        self._random = random.Random()
+
+    def incr(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def record(self, name, seconds, error=False):
+        self._lock.acquire()
+        try:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = _Timing()
+            timing.count += 1
+            if error:
+                timing.errors += 1
+            timing.total += seconds
+            timing.max = max(timing.max, seconds)
+            if len(timing.samples) < self.reservoir_size:
+                timing.samples.append(seconds)
+            else:
+                i = self._random.randint(0, timing.count - 1)
+                if i < self.reservoir_size:
+                    timing.samples[i] = seconds
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Return the counters and, for each timer, its call and error
+        counts, total, mean, max and p50/p95/p99 latencies in seconds."""
+        self._lock.acquire()
+        try:
+            counters = dict(self._counters)
+            timings = {}
+            for name, timing in self._timings.iteritems():
+                samples = sorted(timing.samples)
+                timings[name] = {'count': timing.count,
+                                 'errors': timing.errors,
+                                 'total': timing.total,
+                                 'mean': timing.total / timing.count,
+                                 'max': timing.max,
+                                 'p50': percentile(samples, 50),
+                                 'p95': percentile(samples, 95),
+                                 'p99': percentile(samples, 99)}
+        finally:
+            self._lock.release()
+        return {'counters': counters, 'timers': timings}
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of sorted samples."""
+    if not samples:
+        return None
+    rank = int(round(pct / 100.0 * len(samples) + 0.5)) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+def timed(name):
+    """Decorate a method to record its latency in the `metrics` attribute
+    of its instance, calls raising an exception counting as errors."""
+    def decorate(func):
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            error = True
+            try:
+                result = func(self, *args, **kwargs)
+                error = False
+                return result
+            finally:
+                self.metrics.record(name, time.time() - start, error)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
@@ -0,0 +1,19 @@
+""" Tests
+"""
+# pylint: disable-msg=C0301, C0111
+
+import unittest
+
+from github.tests import test_gitbatch, test_hook, test_ledger, test_outbox
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(test_gitbatch.suite())
+    suite.addTest(test_hook.suite())
+    suite.addTest(test_ledger.suite())
+    suite.addTest(test_outbox.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
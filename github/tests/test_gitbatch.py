@@ -0,0 +1,81 @@
+""" git cat-file --batch tests
+"""
+# pylint: disable-msg=C0301, C0111
+
+import os
+import shutil
+import tempfile
+import unittest
+from subprocess import Popen, PIPE
+
+from github.gitbatch import CatFilePool
+
+
+def git(cwd, *args, **kwargs):
+    env = dict(os.environ,
+               GIT_AUTHOR_NAME='Joe', GIT_AUTHOR_EMAIL='joe@example.org',
+               GIT_COMMITTER_NAME='Joe', GIT_COMMITTER_EMAIL='joe@example.org')
+    proc = Popen(('git',) + args, cwd=cwd, env=env, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    out, err = proc.communicate(kwargs.get('input'))
+    if proc.returncode:
+        raise OSError("git %s failed: %s" % (' '.join(args), err))
+    return out.strip()
+
+
+class CatFilePoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='github-test-')
+        self.repodir = os.path.join(self.tmpdir, 'repo.git')
+        git(self.tmpdir, 'init', '-q', '--bare', self.repodir)
+        self.blob = git(self.repodir, 'hash-object', '-w', '--stdin', input='content\n')
+        tree = git(self.repodir, 'mktree', input='100644 blob %s\tREADME\n' % self.blob)
+        self.first = git(self.repodir, 'commit-tree', tree, '-m', 'First commit\n\nrefs #1\nand #2')
+        self.second = git(self.repodir, 'commit-tree', tree, '-p', self.first, '-m', u'Second \xe9'.encode('utf-8'))
+        self.pool = CatFilePool(self.repodir, 2)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_resolve_commit(self):
+        self.assertEqual(self.first, self.pool.resolve_commit(self.first[:7]))
+        self.assertEqual(self.second, self.pool.resolve_commit(self.second.upper()))
+
+    def test_resolve_missing(self):
+        self.assertEqual(None, self.pool.resolve_commit('deadbeef' * 5))
+
+    def test_resolve_not_a_commit(self):
+        self.assertEqual(None, self.pool.resolve_commit(self.blob[:7]))
+
+    def test_stderr_is_quiet(self):
+        saved = os.dup(2)
+        errors = tempfile.TemporaryFile()
+        os.dup2(errors.fileno(), 2)
+        try:
+            self.pool.resolve_commit(self.blob[:7])
+            self.pool.resolve_commit(self.blob)
+        finally:
+            os.dup2(saved, 2)
+            os.close(saved)
+        errors.seek(0)
+        self.assertEqual('', errors.read())
+
+    def test_commit_message(self):
+        self.assertEqual(u'First commit refs #1 and #2', self.pool.commit_message(self.first))
+        self.assertEqual(u'Second \xe9', self.pool.commit_message(self.second))
+
+    def test_commit_message_not_a_commit(self):
+        self.assertEqual(None, self.pool.commit_message(self.blob))
+
+    def test_processes_reused(self):
+        for i in xrange(5):
+            self.pool.resolve_commit(self.first[:7])
+        self.assertEqual(1, len(self.pool._idle[False]))
+
+
+def suite():
+    return unittest.makeSuite(CatFilePoolTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,91 @@
+""" Commit hook tests
+"""
+# pylint: disable-msg=C0301, C0111
+
+import unittest
+from datetime import datetime, timedelta
+
+from trac.test import EnvironmentStub
+from trac.ticket import Ticket
+#provides the notification templates
+from trac.ticket.web_ui import TicketModule
+from trac.util.datefmt import utc
+
+from github import hook
+from github.hook import CommitHook, TicketConflict
+
+
+class CommitHookTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True, enable=['trac.*', TicketModule])
+        self.hook = CommitHook(self.env)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'Conflicting'
+        ticket['reporter'] = 'joe'
+        ticket.insert(when=datetime.now(utc) - timedelta(hours=1))
+        self.retry_delay = hook.RETRY_DELAY
+        hook.RETRY_DELAY = 0
+
+    def tearDown(self):
+        hook.RETRY_DELAY = self.retry_delay
+        self.env.reset_db()
+
+    def _commit(self, message):
+        return {'id': 'a' * 40, 'url': 'http://example.org/commit', 'message': message,
+                'author': {'name': 'jane'}}
+
+    def _change_meanwhile(self, times):
+        """Make the close command save another change to the ticket, as
+        another process would, the first `times` times it runs."""
+        calls = []
+        close = self.hook._cmdClose
+        def cmd(ticket, status):
+            calls.append(ticket.id)
+            if len(calls) <= times:
+                other = Ticket(self.env, ticket.id)
+                other.save_changes('bob', 'Meanwhile %d' % len(calls), datetime.now(utc))
+            close(ticket, status)
+        self.hook._cmdClose = cmd
+        return calls
+
+    def _comments(self):
+        return [change[4] for change in Ticket(self.env, 1).get_changelog()
+                if change[2] == 'comment']
+
+    def test_conflict_retried(self):
+        calls = self._change_meanwhile(1)
+        self.hook.process(self._commit('Fixes #1'), 'closed', 0, 'repo')
+        self.assertEqual(2, len(calls))
+        self.assertEqual('closed', Ticket(self.env, 1)['status'])
+        comments = self._comments()
+        self.assertEqual(2, len(comments))
+        self.assertEqual('Meanwhile 1', comments[0])
+        self.assertTrue(comments[1].endswith('Fixes #1'))
+        self.assertEqual(1, self.hook.metrics.snapshot()['counters']['ticket_conflicts'])
+
+    def test_conflict_gives_up(self):
+        calls = self._change_meanwhile(hook.SAVE_ATTEMPTS)
+        self.assertRaises(TicketConflict, self.hook.process,
+                          self._commit('Fixes #1'), 'closed', 0, 'repo')
+        self.assertEqual(hook.SAVE_ATTEMPTS, len(calls))
+        self.assertNotEqual('closed', Ticket(self.env, 1)['status'])
+        self.assertEqual(hook.SAVE_ATTEMPTS, len(self._comments()))
+
+    def test_other_errors_not_retried(self):
+        calls = []
+        def update_ticket(*args):
+            calls.append(args)
+            raise ValueError('broken')
+        self.hook._update_ticket = update_ticket
+        self.assertRaises(ValueError, self.hook.process,
+                          self._commit('Fixes #1'), 'closed', 0, 'repo')
+        self.assertEqual(1, len(calls))
+        self.assertEqual([], self._comments())
+
+
+def suite():
+    return unittest.makeSuite(CommitHookTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
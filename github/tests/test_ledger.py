@@ -0,0 +1,104 @@
+""" Commit ledger tests
+"""
+# pylint: disable-msg=C0301, C0111
+
+import simplejson
+import unittest
+from datetime import datetime, timedelta
+
+from trac.test import EnvironmentStub
+from trac.ticket import Ticket
+#provides the notification templates
+from trac.ticket.web_ui import TicketModule
+from trac.util.datefmt import utc
+
+from github.github import GithubPlugin
+
+
+class CommitLedgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True, enable=['trac.*', TicketModule, GithubPlugin])
+        self.plugin = GithubPlugin(self.env)
+        db = self.env.get_db_cnx()
+        self.plugin.upgrade_environment(db)
+        db.commit()
+        for summary in ('First', 'Second'):
+            ticket = Ticket(self.env)
+            ticket['summary'] = summary
+            ticket['reporter'] = 'joe'
+            ticket.insert(when=datetime.now(utc) - timedelta(hours=1))
+        self.payload = simplejson.dumps({
+            'repository': {'name': 'repo'},
+            'commits': [self._commit('1', 'Refs #1'), self._commit('2', 'Fixes #2')]})
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _commit(self, c, message):
+        return {'id': c * 40, 'url': 'http://example.org/commit', 'message': message,
+                'author': {'name': 'jane'}}
+
+    def _comments(self, tkt_id):
+        return [change[4] for change in Ticket(self.env, tkt_id).get_changelog()
+                if change[2] == 'comment']
+
+    def _rows(self, table):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT commit_id FROM %s ORDER BY commit_id" % table)
+        return [row[0][0] for row in cursor]
+
+    def _die_on(self, tkt_id):
+        """Make the process die while saving the changes of a ticket."""
+        update = self.plugin.hook._update_ticket
+        def update_ticket(*args):
+            if int(args[0]) == tkt_id:
+                raise SystemExit()
+            return update(*args)
+        self.plugin.hook._update_ticket = update_ticket
+
+    def test_redelivery_after_partial_failure(self):
+        self._die_on(2)
+        self.assertRaises(SystemExit, self.plugin.processPayload, self.payload)
+        self.assertEqual(['1'], self._rows('github_commits'))
+        self.assertEqual([], self._rows('github_claims'))
+        self.assertEqual(1, len(self._comments(1)))
+        self.assertEqual([], self._comments(2))
+
+        del self.plugin.hook._update_ticket
+        self.plugin.processPayload(self.payload)
+        self.assertEqual(['1', '2'], self._rows('github_commits'))
+        self.assertEqual(1, len(self._comments(1)))
+        self.assertEqual('closed', Ticket(self.env, 2)['status'])
+
+        self.plugin.processPayload(self.payload)
+        self.assertEqual(2 + 1, self.plugin.ledger.skipped)
+        self.assertEqual(1, len(self._comments(1)))
+        self.assertEqual(1, len(self._comments(2)))
+
+    def test_stale_claims(self):
+        claimed = []
+        list(self.plugin.ledger.claim('repo', [self._commit('1', 'Refs #1')], claimed))
+        self.assertEqual(['1' * 40], claimed)
+
+        #the process which claimed the commit is still processing it
+        self.plugin.processPayload(self.payload)
+        self.assertEqual([], self._comments(1))
+        self.assertEqual(['1'], self._rows('github_claims'))
+
+        #it died
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("UPDATE github_claims SET started=0")
+        db.commit()
+        self.plugin.processPayload(self.payload)
+        self.assertEqual(1, len(self._comments(1)))
+        self.assertEqual(['1', '2'], self._rows('github_commits'))
+        self.assertEqual([], self._rows('github_claims'))
+
+
+def suite():
+    return unittest.makeSuite(CommitLedgerTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
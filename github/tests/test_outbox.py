@@ -0,0 +1,126 @@
+""" Notification outbox tests
+"""
+# pylint: disable-msg=C0301, C0111
+
+import smtpd
+import asyncore
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from trac.db.sqlite_backend import _to_sql
+from trac.test import EnvironmentStub
+from trac.ticket import Ticket
+#provides the notification templates
+from trac.ticket.web_ui import TicketModule
+from trac.util.datefmt import utc
+
+from github.mail import BatchSmtpEmailSender
+from github.outbox import NotificationOutbox
+
+
+class SMTPServer(smtpd.DebuggingServer):
+    """Records the messages it receives and counts the connections."""
+
+    def __init__(self):
+        smtpd.DebuggingServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.DebuggingServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(data)
+
+
+class NotificationOutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SMTPServer()
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', TicketModule, BatchSmtpEmailSender])
+        for name, value in (('smtp_enabled', 'true'),
+                            ('smtp_server', '127.0.0.1'),
+                            ('smtp_port', str(self.server.port)),
+                            ('smtp_from', 'trac@example.org'),
+                            ('always_notify_reporter', 'true'),
+                            ('email_sender', 'BatchSmtpEmailSender')):
+            self.env.config.set('notification', name, value)
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        for table in NotificationOutbox.SCHEMA:
+            for stmt in _to_sql(table):
+                cursor.execute(stmt)
+        db.commit()
+        self.outbox = NotificationOutbox(self.env, window=60)
+        self.time = datetime.now(utc) - timedelta(hours=1)
+
+    def tearDown(self):
+        self.server.stop()
+        self.env.reset_db()
+
+    def _insert_ticket(self, summary):
+        ticket = Ticket(self.env)
+        ticket['summary'] = summary
+        ticket['reporter'] = 'joe@example.org'
+        ticket.insert(when=self.time)
+        return ticket
+
+    def _change_ticket(self, ticket, comment, **fields):
+        self.time += timedelta(seconds=1)
+        ticket.populate(fields)
+        ticket.save_changes('jane', comment, self.time)
+        db = self.env.get_db_cnx()
+        self.outbox.add(ticket.id, self.time, db)
+        db.commit()
+
+    def test_window(self):
+        ticket = self._insert_ticket('Waiting')
+        self.outbox.window = 3600
+        self._change_ticket(ticket, 'not yet')
+        self.assertEqual(0, self.outbox.flush())
+        self.assertEqual([], self.server.messages)
+        self.assertEqual({'pending': 1}, self.outbox.depth())
+
+    def test_one_connection_per_batch(self):
+        for summary in ('First', 'Second', 'Third'):
+            self._change_ticket(self._insert_ticket(summary), 'Changed %s' % summary)
+        self.assertEqual(3, self.outbox.flush(force=True))
+        self.assertEqual(3, len(self.server.messages))
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual({}, self.outbox.depth())
+
+    def test_coalesced_changes(self):
+        ticket = self._insert_ticket('Coalesced')
+        self._change_ticket(ticket, 'First change', priority='major')
+        self._change_ticket(ticket, 'Second change', priority='critical')
+        self.assertEqual(1, self.outbox.flush(force=True))
+        self.assertEqual(1, len(self.server.messages))
+        message = self.server.messages[0]
+        self.assertTrue('First change' in message)
+        self.assertTrue('Second change' in message)
+        self.assertTrue('critical' in message)
+        self.assertEqual(1, self.outbox.sent)
+
+
+def suite():
+    return unittest.makeSuite(NotificationOutboxTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')